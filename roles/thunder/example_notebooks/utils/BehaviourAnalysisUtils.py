@@ -1,42 +1,35 @@
 import argparse
+import datetime
+import os
 import sys
 import re
 import dateutil.parser as dparser
+import numpy as np
+
+# log line: date, time, trial number and event description
+LOG_LINE = re.compile('(\S{5,20})\s\t(\S{5,20})\t(\d{1,3})\t(.*)')
+# fixed-format time of day, parsed without dateutil
+LOG_TIME = re.compile('(\d{1,2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?$')
+
+# categories of the decision column in parseBehaviourLogTable
+DECISIONS = ['Early', 'Go', 'No Go', 'Inappropriate Response', 'No Response']
+
+# trial outcomes (see trialOutcomes), by appropriate decision (EXPECTED) and decision (DECISIONS)
+OUTCOMES = ['other', 'hit', 'miss', 'correct_reject', 'false_alarm', 'early']
+EXPECTED = [None, 'Go', 'No Go']
+OUTCOME_TABLE = np.array([
+    # Early, Go, No Go, Inappropriate Response, No Response
+    [5, 0, 0, 0, 0],  # no appropriate decision defined
+    [5, 1, 2, 0, 2],  # Go stimulus
+    [5, 4, 3, 4, 0],  # No Go stimulus
+], dtype=np.intp)
+
 
 def parseBehaviourLog(path_to_file, print_table=False):
     '''
     Parse the behaviour log file and return trial table (one row per trial)
     '''
-    import re
-    import dateutil.parser as dparser
-
-    p = re.compile('(\S{5,20})\s\t(\S{5,20})\t(\d{1,3})\t')
-    trial_list = []
-    trial_count = 0
-    with open(path_to_file) as fid:
-        for line in fid:
-            if line.startswith('Date'): # skip line 1
-                pass
-            else:
-                parsed = p.split(line.strip())
-                date_time = dparser.parse(parsed[1] + ' ' + parsed[2])
-                trial = int(parsed[3])
-                descr = parsed[4]
-                if descr.startswith('Begin Trial'):
-                    current_decision = 'Early'
-                    trial_count += 1
-                    current_trial = trial
-                    trial_start = date_time
-                elif descr.startswith('Texture'):
-                    current_stim = descr
-                elif descr == 'Go' or descr == 'No Go' or descr == 'Inappropriate Response' \
-                or descr == 'No Response':
-                    current_decision = descr
-                elif descr == 'End Trial':
-                    current_trial_list = [trial_count, current_trial, trial_start, current_stim, current_decision]
-                    trial_list.append(current_trial_list)
-                else:
-                    pass
+    trial_list = list(iterBehaviourTrials(path_to_file))
     # print table
     if print_table:
         print 'ID1\tID2\tStartTime\tStimulus\tDecision'
@@ -46,6 +39,128 @@ def parseBehaviourLog(path_to_file, print_table=False):
     return trial_list
 
 
+def iterBehaviourTrials(path_to_file, chunk_bytes=4*2**20):
+    '''
+    Stream the behaviour log file in chunks of chunk_bytes and yield one trial list
+    [trial_count, trial, start time, stimulus, decision] per trial (see parseBehaviourLog)
+    '''
+    parseTime = logTimeParser()
+    trial_count = 0
+    current_trial = trial_start = current_stim = None
+    current_decision = 'Early'
+    for line in iterLines(path_to_file, chunk_bytes):
+        if line.startswith('Date'): # skip line 1
+            continue
+        parsed = LOG_LINE.match(line.strip())
+        if parsed is None:
+            continue
+        descr = parsed.group(4)
+        if descr.startswith('Begin Trial'):
+            current_decision = 'Early'
+            trial_count += 1
+            current_trial = int(parsed.group(3))
+            trial_start = parseTime(parsed.group(1), parsed.group(2))
+        elif descr.startswith('Texture'):
+            current_stim = descr
+        elif descr == 'Go' or descr == 'No Go' or descr == 'Inappropriate Response' \
+        or descr == 'No Response':
+            current_decision = descr
+        elif descr == 'End Trial':
+            yield [trial_count, current_trial, trial_start, current_stim, current_decision]
+
+
+def iterLines(path_to_file, chunk_bytes=4*2**20):
+    '''
+    Read a text file in large chunks and yield its lines
+    '''
+    with open(path_to_file) as fid:
+        rest = ''
+        while True:
+            chunk = fid.read(chunk_bytes)
+            if not chunk:
+                break
+            lines = (rest + chunk).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        if rest:
+            yield rest
+
+
+def logTimeParser():
+    '''
+    Return a function parsing the date and time strings of a log line into a datetime.
+
+    Every distinct date string is parsed only once with dateutil and cached; times of the form
+    HH:MM:SS[.ffffff] are parsed directly. Other formats fall back to dateutil.
+    '''
+    dates = {}
+
+    def parseTime(date_str, time_str):
+        match = LOG_TIME.match(time_str)
+        if match is None:
+            return dparser.parse(date_str + ' ' + time_str)
+        if date_str not in dates:
+            dates[date_str] = dparser.parse(date_str).date()
+        hour, minute, second, fraction = match.groups()
+        microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+        return datetime.datetime.combine(dates[date_str],
+                                         datetime.time(int(hour), int(minute), int(second), microsecond))
+    return parseTime
+
+
+def parseBehaviourLogTable(path_to_file):
+    '''
+    Parse the behaviour log file into a columnar trial table.
+
+    Return a numpy structured array with the fields trial_id, trial, start_time (datetime64[us]),
+    stim and decision, and a dict with the categories of the stim and decision codes, i.e.
+    categories['stim'][table['stim'][i]] is the stimulus of trial i (code -1 for no stimulus).
+    '''
+    trials = list(iterBehaviourTrials(path_to_file))
+    stims = sorted(set(t[3] for t in trials if t[3] is not None))
+    stim_codes = dict((stim, code) for code, stim in enumerate(stims))
+    stim_codes[None] = -1
+    decision_codes = dict((decision, code) for code, decision in enumerate(DECISIONS))
+    table = np.empty(len(trials), dtype=[('trial_id', 'i4'), ('trial', 'i4'), ('start_time', 'M8[us]'),
+                                         ('stim', 'i2'), ('decision', 'i2')])
+    table['trial_id'] = [t[0] for t in trials]
+    table['trial'] = [t[1] for t in trials]
+    table['start_time'] = np.array([t[2] for t in trials], dtype='M8[us]')
+    table['stim'] = [stim_codes[t[3]] for t in trials]
+    table['decision'] = [decision_codes[t[4]] for t in trials]
+    return table, {'stim': stims, 'decision': list(DECISIONS)}
+
+
+def parseBehaviourLogCached(path_to_file):
+    '''
+    parseBehaviourLogTable, memoized on disk and keyed by the modification time of the file
+    '''
+    import CacheUtils
+    return CacheUtils.cachedByMtime(lambda: parseBehaviourLogTable(path_to_file), path_to_file,
+                                    key='parseBehaviourLogTable')
+
+
+def parseBehaviourDirectory(directory, pattern='*.txt', n_processes=4, use_cache=True):
+    '''
+    Parse all behaviour log files matching pattern in directory with a process pool.
+
+    Return a dict with file paths as keys and (table, categories) from parseBehaviourLogTable as values.
+    '''
+    import glob
+    from multiprocessing import Pool
+    file_list = sorted(glob.glob(os.path.join(directory, pattern)))
+    parse = parseBehaviourLogCached if use_cache else parseBehaviourLogTable
+    if n_processes <= 1 or len(file_list) <= 1:
+        return dict((f, parse(f)) for f in file_list)
+    pool = Pool(min(n_processes, len(file_list)))
+    try:
+        tables = pool.map(parse, file_list)
+    finally:
+        pool.close()
+    return dict(zip(file_list, tables))
+
+
 def analyzeBehaviourPerformance(trial_list, stim_decision, print_summary=False):
     '''
     Analyze behaviour performance for trials in trial_list and return:
@@ -62,35 +177,18 @@ def analyzeBehaviourPerformance(trial_list, stim_decision, print_summary=False):
             ]
     '''
     # analyse trial list for behavioural performance
-    corr_response = 0
-    corr_reject = 0
-    false_alarm = 0
-    miss_response = 0
-    early_licks = 0
-    go_trials = 0
-    nogo_trials = 0
-    for i_trial in trial_list:
-        current_stim = i_trial[3]
-        current_dec = i_trial[4]
-        appropriate_decision = [a for a in stim_decision if a[0] == current_stim][0][1]
-        if appropriate_decision == 'Go' and current_dec == 'Go':
-            go_trials += 1
-            # correct response
-            corr_response += 1
-        if appropriate_decision == 'Go' and (current_dec == 'No Go' or current_dec == 'No Response'):
-            go_trials += 1
-            # missed response
-            miss_response += 1
-        if appropriate_decision == 'No Go' and current_dec == 'No Go':
-            nogo_trials += 1
-            # correct reject
-            corr_reject += 1
-        if appropriate_decision == 'No Go' and (current_dec == 'Go' or current_dec == 'Inappropriate Response'):
-            nogo_trials += 1
-            # false alarm
-            false_alarm += 1
-        if current_dec == 'Early':
-            early_licks += 1
+    expected = dict((a[0], EXPECTED.index(a[1])) for a in stim_decision)
+    decision_codes = dict((decision, code) for code, decision in enumerate(DECISIONS))
+    outcomes = OUTCOME_TABLE[[expected.get(t[3], 0) for t in trial_list],
+                             [decision_codes[t[4]] for t in trial_list]]
+    counts = dict(zip(OUTCOMES, [int(c) for c in np.bincount(outcomes, minlength=len(OUTCOMES))]))
+    corr_response = counts['hit']
+    corr_reject = counts['correct_reject']
+    false_alarm = counts['false_alarm']
+    miss_response = counts['miss']
+    early_licks = counts['early']
+    go_trials = corr_response + miss_response
+    nogo_trials = corr_reject + false_alarm
     if print_summary:
         print 'Go trials (%s): %1.0f' % ([a[0] for a in stim_decision if a[1] == 'Go'][0], go_trials)
         print 'No Go trials (%s): %1.0f' % ([a[0] for a in stim_decision if a[1] == 'No Go'][0], nogo_trials)
@@ -103,6 +201,109 @@ def analyzeBehaviourPerformance(trial_list, stim_decision, print_summary=False):
     return (go_trials, nogo_trials, corr_response, corr_reject, miss_response, false_alarm)
 
 
+def trialOutcomes(table, categories, stim_decision):
+    '''
+    Classify every trial of a trial table (see parseBehaviourLogTable) with one lookup.
+
+    stim_decision ... mapping of stimulus to appropriate decision (see analyzeBehaviourPerformance)
+    Return an array with the index of the outcome in OUTCOMES for every trial.
+    '''
+    expected = dict((a[0], EXPECTED.index(a[1])) for a in stim_decision)
+    # appropriate decision per stimulus code, the last entry is for trials without stimulus (code -1)
+    stim_expected = np.array([expected.get(stim, 0) for stim in categories['stim']] + [0], dtype=np.intp)
+    decision_map = np.array([DECISIONS.index(d) for d in categories['decision']], dtype=np.intp)
+    return OUTCOME_TABLE[stim_expected[table['stim']], decision_map[table['decision']]]
+
+
+def performanceSummary(counts):
+    '''
+    Return a dict with the arrays go_trials, nogo_trials, hits, misses, correct_rejects, false_alarms,
+    early_licks and dprime from outcome counts (groups, OUTCOMES).
+
+    d' is calculated with the log-linear correction, (hits + 0.5) / (go_trials + 1), so that it stays
+    finite for perfect performance.
+    '''
+    from scipy.stats import norm
+    counts = np.asarray(counts)
+    summary = dict((name, counts[:, OUTCOMES.index(outcome)]) for name, outcome in
+                   [('hits', 'hit'), ('misses', 'miss'), ('correct_rejects', 'correct_reject'),
+                    ('false_alarms', 'false_alarm'), ('early_licks', 'early')])
+    summary['go_trials'] = summary['hits'] + summary['misses']
+    summary['nogo_trials'] = summary['correct_rejects'] + summary['false_alarms']
+    hit_rate = (summary['hits'] + 0.5) / (summary['go_trials'] + 1.0)
+    fa_rate = (summary['false_alarms'] + 0.5) / (summary['nogo_trials'] + 1.0)
+    summary['dprime'] = norm.ppf(hit_rate) - norm.ppf(fa_rate)
+    return summary
+
+
+def groupedCounts(outcomes, groups, n_groups=None):
+    '''
+    Count the outcomes (see trialOutcomes) per group index with a single bincount.
+    Return an array (groups, OUTCOMES).
+    '''
+    if n_groups is None:
+        n_groups = int(groups.max()) + 1 if len(groups) else 0
+    n_outcomes = len(OUTCOMES)
+    counts = np.bincount(groups * n_outcomes + outcomes, minlength=n_groups * n_outcomes)
+    return counts.reshape(n_groups, n_outcomes)
+
+
+def rollingCounts(outcomes, window, session_start=None):
+    '''
+    Count the outcomes (see trialOutcomes) over a window of the last window trials for every trial,
+    using cumulative sums. Windows do not reach back beyond session_start (index of the first trial
+    of the session of every trial). Return an array (trials, OUTCOMES).
+    '''
+    n = len(outcomes)
+    one_hot = np.zeros((n + 1, len(OUTCOMES)), dtype=np.int64)
+    one_hot[np.arange(1, n + 1), outcomes] = 1
+    csum = np.cumsum(one_hot, axis=0)
+    start = np.maximum(np.arange(n) - window + 1, 0)
+    if session_start is not None:
+        start = np.maximum(start, session_start)
+    return csum[1:] - csum[start]
+
+
+def analyzeBehaviourSessions(sessions, stim_decision, block_size=None, window=None):
+    '''
+    Analyze behaviour performance of many sessions at once.
+
+    sessions ... dict with session names as keys and (table, categories) from parseBehaviourLogTable
+        as values, e.g. from parseBehaviourDirectory
+    stim_decision ... mapping of stimulus to appropriate decision (see analyzeBehaviourPerformance)
+    block_size ... additionally summarize blocks of block_size trials per session
+    window ... additionally summarize a rolling window of the last window trials for every trial
+
+    Return a dict with 'sessions' (sorted session names), 'session' (performanceSummary per session)
+    and optionally 'block' and 'rolling' (performanceSummary per block / trial, together with the
+    arrays 'session_ix' and 'block_ix' or 'trial_ix').
+    '''
+    names = sorted(sessions)
+    outcomes = [trialOutcomes(sessions[name][0], sessions[name][1], stim_decision) for name in names]
+    lengths = np.array([len(o) for o in outcomes], dtype=np.intp)
+    outcomes = np.concatenate(outcomes) if names else np.zeros(0, dtype=np.intp)
+    session_ix = np.repeat(np.arange(len(names)), lengths)
+    session_start = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    trial_ix = np.arange(len(outcomes)) - session_start
+
+    result = {'sessions': names, 'session': performanceSummary(groupedCounts(outcomes, session_ix, len(names)))}
+    if block_size:
+        # number the blocks consecutively across sessions
+        n_blocks = (lengths + block_size - 1) // block_size
+        first_block = np.cumsum(n_blocks) - n_blocks
+        blocks = first_block[session_ix] + trial_ix // block_size
+        block = performanceSummary(groupedCounts(outcomes, blocks, int(n_blocks.sum())))
+        block['session_ix'] = np.repeat(np.arange(len(names)), n_blocks)
+        block['block_ix'] = np.arange(int(n_blocks.sum())) - np.repeat(first_block, n_blocks)
+        result['block'] = block
+    if window:
+        rolling = performanceSummary(rollingCounts(outcomes, window, session_start))
+        rolling['session_ix'] = session_ix
+        rolling['trial_ix'] = trial_ix
+        result['rolling'] = rolling
+    return result
+
+
 def parseCommandLineArgs(args):
     '''
     Parse command line arguments. Return full path to logfile and stim-decision list
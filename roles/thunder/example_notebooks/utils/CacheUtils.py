@@ -0,0 +1,322 @@
+import hashlib
+import inspect
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    # str and unicode paths on Python 2
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# root directory of the local caches of the utils modules
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'helmchen-spark')
+
+
+def fileKey(filename):
+    """
+    Return the identity of a local file as (absolute path, mtime, size).
+    """
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_mtime, st.st_size)
+
+
+def cachedByMtime(func, filename, key=None, cache_dir=None):
+    """
+    Return func(), memoized on disk under the identity of filename (see fileKey) and key.
+
+    func ... function without arguments that derives its result from filename
+    key ... additional parameters (with a stable repr) that the result depends on
+    cache_dir ... directory of the pickled results (default CACHE_DIR/mtime)
+
+    The result is recomputed whenever the file is modified. If filename does not exist, func is called
+    without caching.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(CACHE_DIR, 'mtime')
+    try:
+        file_key = fileKey(filename)
+    except OSError:
+        return func()
+    digest = hashlib.sha1(repr((file_key, key)).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(cache_dir, digest + '.pkl')
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rb') as fid:
+                return pickle.load(fid)
+        except Exception as e:
+            logger.warning('Ignoring unreadable cache file %s: %s' % (cache_file, e))
+    result = func()
+    writePickle(result, cache_file)
+    return result
+
+
+def writePickle(obj, cache_file):
+    """
+    Pickle obj to cache_file, writing to a temporary file first so that readers never see partial files.
+    """
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # created concurrently
+            pass
+    temp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(temp_file, 'wb') as fid:
+        pickle.dump(obj, fid, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_file, cache_file)
+
+
+class ContentCache(object):
+    """
+    Size-bounded on-disk cache of function results, addressed by a digest of the function and its inputs.
+
+    cache_dir ... local directory of the entries (default CACHE_DIR/content)
+    max_bytes ... the least recently used entries are evicted when the entries exceed max_bytes
+    shared_dir ... optional directory on shared storage (e.g. an NFS or HDFS mount) that is searched
+                   on local misses and receives every new entry
+    swift ... optional (container, folder, conn_opts) to share the entries via Swift instead
+
+    Every entry is a directory with the result pickled by PickleUtils.serialize, so large arrays are
+    loaded memory-mapped (copy-on-write). Hits and misses per function are counted in stats, per
+    process (i.e. separately on every Spark executor).
+    """
+    def __init__(self, cache_dir=None, max_bytes=20*2**30, shared_dir=None, swift=None):
+        self.cache_dir = cache_dir or os.path.join(CACHE_DIR, 'content')
+        self.max_bytes = max_bytes
+        self.shared_dir = shared_dir
+        self.swift = swift
+        self.stats = dict()
+
+    def count(self, name, event):
+        counts = self.stats.setdefault(name, {'hits': 0, 'shared_hits': 0, 'misses': 0})
+        counts[event] += 1
+
+    def entryFile(self, entry_dir):
+        return os.path.join(entry_dir, 'result_0.pkl')
+
+    def get(self, digest, name=None):
+        """
+        Return (True, result) for a cached digest, or (False, None).
+        """
+        import PickleUtils
+        entry_dir = os.path.join(self.cache_dir, digest)
+        if os.path.isdir(entry_dir):
+            self.count(name, 'hits')
+        elif self.fetchShared(digest):
+            self.count(name, 'shared_hits')
+        else:
+            self.count(name, 'misses')
+            return False, None
+        try:
+            result = PickleUtils.deserialize(self.entryFile(entry_dir), mmap_mode='c')
+        except Exception as e:
+            logger.warning('Removing unreadable cache entry %s: %s' % (entry_dir, e))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return False, None
+        # mark the entry as recently used
+        os.utime(entry_dir, None)
+        return True, result
+
+    def put(self, digest, result):
+        """
+        Store result under digest, share it and evict the least recently used entries.
+        """
+        import PickleUtils
+        entry_dir = os.path.join(self.cache_dir, digest)
+        temp_dir = '%s.%d.tmp' % (entry_dir, os.getpid())
+        # left over from an interrupted process with the same pid
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        PickleUtils.serialize(result, 'result', temp_dir, 0)
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # stored concurrently
+            shutil.rmtree(temp_dir)
+            return
+        self.putShared(digest)
+        self.evict()
+
+    def fetchShared(self, digest):
+        """
+        Copy the entry digest from the shared store to the local cache, return True if it was found.
+        """
+        entry_dir = os.path.join(self.cache_dir, digest)
+        temp_dir = '%s.%d.tmp' % (entry_dir, os.getpid())
+        if self.shared_dir is not None:
+            shared_entry = os.path.join(self.shared_dir, digest)
+            if not os.path.isdir(shared_entry):
+                return False
+            shutil.copytree(shared_entry, temp_dir)
+        elif self.swift is not None:
+            from SwiftStorageUtils import iterItems, downloadItems
+            container, folder, conn_opts = self.swift
+            prefix = '%s/%s/' % (folder, digest)
+            objects = [item['name'] for item in iterItems(container, conn_opts, prefix)]
+            if not objects:
+                return False
+            down_opts = {'out_directory': temp_dir, 'prefix': prefix, 'remove_prefix': True}
+            if not downloadItems(container, objects, conn_opts, down_opts):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                return False
+        else:
+            return False
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(temp_dir)
+        return True
+
+    def putShared(self, digest):
+        entry_dir = os.path.join(self.cache_dir, digest)
+        if self.shared_dir is not None:
+            shared_entry = os.path.join(self.shared_dir, digest)
+            if not os.path.isdir(shared_entry):
+                temp_dir = '%s.%d.tmp' % (shared_entry, os.getpid())
+                shutil.copytree(entry_dir, temp_dir)
+                try:
+                    os.rename(temp_dir, shared_entry)
+                except OSError:
+                    shutil.rmtree(temp_dir)
+        elif self.swift is not None:
+            from SwiftStorageUtils import uploadItems
+            container, folder, conn_opts = self.swift
+            file_list = [os.path.join(root, f) for root, _, files in os.walk(entry_dir) for f in files]
+            uploadItems(container, '%s/%s' % (folder, digest), entry_dir + os.path.sep, file_list, conn_opts)
+
+    def entries(self):
+        """
+        Return a list of (last use, bytes, entry directory) of all local entries.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for digest in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, digest)
+            if digest.endswith('.tmp') or not os.path.isdir(entry_dir):
+                continue
+            n_bytes = sum(os.path.getsize(os.path.join(root, f))
+                          for root, _, files in os.walk(entry_dir) for f in files)
+            entries.append((os.path.getmtime(entry_dir), n_bytes, entry_dir))
+        return entries
+
+    def evict(self):
+        """
+        Delete the least recently used local entries until they fit into max_bytes.
+        """
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for _, n_bytes, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= n_bytes
+            logger.info('Evicted cache entry %s (%d bytes)' % (entry_dir, n_bytes))
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+# cache used by memoize if no cache is given
+DEFAULT_CACHE = ContentCache()
+
+
+def arrayDigest(a, block_bytes=64*2**20):
+    """
+    Return the sha1 hex digest of dtype, shape and content of numpy array a (hashed in blocks).
+    """
+    h = hashlib.sha1(repr((a.dtype.str, a.shape)).encode('utf-8'))
+    if a.ndim == 0 or a.shape[0] == 0:
+        h.update(np.ascontiguousarray(a).tobytes())
+        return h.hexdigest()
+    rows = max(1, block_bytes // max(1, a[0].nbytes))
+    for start in range(0, a.shape[0], rows):
+        h.update(np.ascontiguousarray(a[start:start+rows]).data)
+    return h.hexdigest()
+
+
+def valueKey(value):
+    """
+    Return a stable, hashable description of a function argument:
+    arrays by content (see arrayDigest), paths of existing files by identity (see fileKey), Swift objects
+    opened with SwiftStorageUtils.openObject by their ETag, containers recursively and other values by repr.
+    """
+    if isinstance(value, np.ndarray):
+        return ('ndarray', arrayDigest(value))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(valueKey(v) for v in value))
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted((repr(k), valueKey(v)) for k, v in value.items())))
+    raw = getattr(value, 'raw', value)
+    if hasattr(raw, 'etag'):
+        return ('swift', raw.container, raw.object_name, raw.etag)
+    if hasattr(value, '__fspath__'):
+        # os.PathLike, e.g. pathlib paths
+        value = value.__fspath__()
+    if isinstance(value, string_types) and os.path.isfile(value):
+        return ('file', fileKey(value))
+    return repr(value)
+
+
+def functionKey(func):
+    """
+    Return the module, name and a digest of the code of func (byte code, constants and names, including
+    nested functions), so that cached results are invalidated when the function changes.
+    """
+    code = getattr(func, '__code__', None)
+    code_digest = hashlib.sha1(codeKey(code).encode('utf-8')).hexdigest() if code is not None else None
+    return (func.__module__, func.__name__, code_digest)
+
+
+def codeKey(obj):
+    """
+    Return a stable string describing a code object or a constant of a code object.
+    """
+    if inspect.iscode(obj):
+        return repr((hashlib.sha1(obj.co_code).hexdigest(), obj.co_names,
+                     tuple(codeKey(c) for c in obj.co_consts)))
+    if isinstance(obj, (tuple, list)):
+        return repr(tuple(codeKey(c) for c in obj))
+    if isinstance(obj, frozenset):
+        # the iteration order of sets depends on the hash seed
+        return repr(('frozenset', sorted(codeKey(c) for c in obj)))
+    return repr(obj)
+
+
+def memoize(func, cache=None, ignore=(), depends=(), version=None):
+    """
+    Return a version of func whose results are stored in a ContentCache (default DEFAULT_CACHE).
+
+    The results are addressed by func (see functionKey) and all its arguments, including defaults
+    (see valueKey), so e.g. a parameter sweep only recomputes the stages whose inputs changed.
+    ignore ... names of arguments that do not change the result (e.g. n_threads)
+    depends ... functions called by func, whose changes also invalidate the results
+    version ... any value with a stable repr, change it to invalidate the results explicitly
+
+    Cached results are returned without calling func, i.e. arguments that func modifies in place are
+    left unchanged on hits; use the return value. Large arrays in results are memory-mapped copy-on-write.
+    """
+    code_keys = [functionKey(f) for f in (func,) + tuple(depends)]
+
+    def memoized(*args, **kwargs):
+        c = DEFAULT_CACHE if cache is None else cache
+        callargs = inspect.getcallargs(func, *args, **kwargs)
+        key = (code_keys, version, sorted((k, valueKey(v)) for k, v in callargs.items() if k not in ignore))
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        found, result = c.get(digest, func.__name__)
+        if found:
+            return result
+        result = func(*args, **kwargs)
+        c.put(digest, result)
+        return result
+    memoized.__name__ = func.__name__
+    memoized.__doc__ = func.__doc__
+    return memoized
@@ -1,37 +1,352 @@
 import numpy as np
 
-def psAnalysis(data, stim, frameIx):
+def stackRecords(records):
+    """
+    Stack the values of (key, time series) records, e.g. of one RDD partition, into one block.
+
+    Return the list of keys and the (records, t) array, or None if there are no records.
+    """
+    records = list(records)
+    if not records:
+        return None
+    return [k for k, v in records], np.vstack([v for k, v in records])
+
+
+def psAnalysis(data, stim, frameIx, axis=0, edge='drop'):
     """
     Compute peri-stimulus averages for different stims.
+
+    data ... numpy array with time along axis, e.g. a trace (t) or traces (pixels, t) with axis=1
+    stim ... stimulus ID for every time point
+    frameIx ... number of frames (before, after) stimulus onset
+    axis ... time axis of data
+    edge ... 'drop' events whose window extends past the data, or 'nan' to pad the window with NaN
+
+    Return a list with one (events, window, ...) array per stim (stim IDs > 1, in ascending order).
+    All windows of a stim are gathered with one fancy-indexing operation.
     """
     # figure out unique stims
-    stimID = stim[stim>1] # first stim is air, which is ignored
-    stimID = np.unique(stimID)
-    nUniqueStims = len(np.unique(stimID))
+    stimID = np.unique(stim[stim>1]) # first stim is air, which is ignored
+    data = np.rollaxis(np.asarray(data), axis)
+    nFrames = data.shape[0]
+    window = np.arange(-frameIx[0], frameIx[1])
     # collect psData for each stim
+    psDataAllStims = []
     for nStim in stimID:
-        stimIx = np.where(stim==nStim)
-        stimIx = stimIx[0]
-        for ix, nStim2 in enumerate(stimIx):
-            startFrame = nStim2 - frameIx[0]
-            stopFrame = nStim2 + frameIx[1]
-            if ix == 0:
-                psData = data[startFrame:stopFrame]
-            else:
-                psData = np.vstack((psData, data[startFrame:stopFrame]))
-        if nStim == np.min(stimID):
-            psDataAllStims = [psData]
+        ix = np.flatnonzero(stim==nStim)[:, np.newaxis] + window[np.newaxis, :]
+        valid = (ix >= 0) & (ix < nFrames)
+        if edge == 'drop':
+            psData = data[ix[valid.all(axis=1)]]
+        elif edge == 'nan':
+            psData = data[np.clip(ix, 0, nFrames-1)].astype(np.float64)
+            psData[~valid] = np.nan
         else:
-            psDataAllStims.append(psData)
+            raise ValueError('Unknown edge handling %s' % edge)
+        psDataAllStims.append(psData)
     return psDataAllStims
 
 
-def calculateDff(mov, f0_frames):
+def psAnalysisRDD(rdd, stim, frameIx, edge='drop'):
+    """
+    Compute peri-stimulus data for an RDD of (key, time series) records, e.g. from convert2RDD.
+
+    The series of each partition are stacked into one (pixels, t) block and processed with a single
+    call of psAnalysis. Return an RDD with (key, psAnalysis(series, stim, frameIx)) records.
+    """
+    def psPartition(records):
+        stacked = stackRecords(records)
+        if stacked is None:
+            return []
+        keys, block = stacked
+        psData = psAnalysis(block, stim, frameIx, axis=1, edge=edge)
+        return [(k, [ps[:, :, i] for ps in psData]) for i, k in enumerate(keys)]
+    return rdd.mapPartitions(psPartition, preservesPartitioning=True)
+
+
+def calculateDff(mov, f0_frames, out=None, dtype=np.float32, baseline='mean', window=None,
+                 percentile=10, block_rows=16):
     """
     Calculate DF/F0 movie
-    dff = ((mov-f0)/f0) * 100
+    dff = ((mov-f0)/f0)
+
+    mov ... numpy array with time as last axis, e.g. movie (x, y, t) or traces (pixels, t)
+    f0_frames ... frames used for F0 (index or boolean array), for baseline 'mean'
+    out ... output array of the same shape as mov; pass mov itself (float) to calculate in place
+        or a np.memmap to write to disk (default: new array of type dtype)
+    baseline ... 'mean' (mean of f0_frames), 'sliding' (running mean over window frames)
+        or 'percentile' (running percentile over window frames)
+    window ... window length (frames) of the sliding baselines
+    percentile ... percentile of the 'percentile' baseline
+    block_rows ... number of rows (first axis) processed at a time
+
+    The movie is processed in blocks of rows, so that only one block is held in memory as float.
+    """
+    if out is None:
+        out = np.empty(mov.shape, dtype=dtype)
+    for start in range(0, mov.shape[0], block_rows):
+        block = np.array(mov[start:start+block_rows], dtype=np.float32)
+        f0 = calculateBaseline(block, f0_frames, baseline, window, percentile)
+        block -= f0
+        block /= f0
+        out[start:start+block_rows] = block
+    return out
+
+
+def calculateBaseline(data, f0_frames=None, baseline='mean', window=None, percentile=10):
+    """
+    Calculate the baseline F0 along the last (time) axis of data (see calculateDff).
+
+    'mean' returns one value per trace, the sliding baselines one value per time point.
+    The running mean is calculated from cumulative sums in O(n). The running percentile is
+    evaluated every window/2 frames and linearly interpolated in between, so its cost also
+    grows linearly with the number of frames.
     """
-    f0 = np.mean(mov[:,:,f0_frames], axis=2)
-    f0 = f0[:, :, np.newaxis]
-    dff = ((mov - f0) / f0)
-    return dff
+    if baseline == 'mean':
+        return np.mean(data[..., f0_frames], axis=-1, keepdims=True)
+    if not window:
+        raise ValueError('Baseline %s requires a window length' % baseline)
+    nt = data.shape[-1]
+    window = min(int(window), nt)
+    if baseline == 'sliding':
+        csum = np.zeros(data.shape[:-1] + (nt + 1,))
+        np.cumsum(data, axis=-1, out=csum[..., 1:])
+        lower = np.clip(np.arange(nt) - window // 2, 0, nt - window)
+        return ((csum[..., lower + window] - csum[..., lower]) / window).astype(data.dtype)
+    elif baseline == 'percentile':
+        step = max(1, window // 2)
+        anchors = np.unique(np.append(np.arange(0, nt, step), nt - 1))
+        lower = np.clip(anchors - window // 2, 0, nt - window)
+        f0 = np.stack([np.percentile(data[..., l:l+window], percentile, axis=-1) for l in lower],
+                      axis=-1)
+        if len(anchors) == 1:
+            return np.repeat(f0, nt, axis=-1).astype(data.dtype)
+        # interpolate linearly between the anchor frames
+        t = np.arange(nt)
+        ix = np.minimum(np.searchsorted(anchors, t, side='right') - 1, len(anchors) - 2)
+        frac = (t - anchors[ix]) / (anchors[ix + 1] - anchors[ix]).astype(np.float64)
+        return (f0[..., ix] * (1 - frac) + f0[..., ix + 1] * frac).astype(data.dtype)
+    raise ValueError('Unknown baseline %s' % baseline)
+
+
+def calculateDffRDD(rdd, f0_frames, baseline='mean', window=None, percentile=10):
+    """
+    Calculate DF/F0 for an RDD of (key, time series) records, e.g. from convert2RDD.
+
+    The series of each partition are stacked into one (pixels, t) block and processed with
+    calculateDff; keys and partitioning are preserved.
+    """
+    def dffPartition(records):
+        stacked = stackRecords(records)
+        if stacked is None:
+            return []
+        keys, block = stacked
+        dff = calculateDff(block, f0_frames, baseline=baseline, window=window, percentile=percentile,
+                           block_rows=len(keys))
+        return list(zip(keys, dff))
+    return rdd.mapPartitions(dffPartition, preservesPartitioning=True)
+
+
+def roiMatrix(roi_dict, dims, roi_names=None):
+    """
+    Pack the Roi masks of roi_dict into one sparse (Rois, pixels) matrix.
+
+    roi_dict ... dict with masks as returned by WidefieldDataUtils.importMatlabRois, in any mask_format
+        ('coords' and 'flat' masks get weight 1, 'sparse' masks keep their interpolated weights)
+    dims ... frame size (x, y); pixels are numbered as flat (C-order) indices into dims
+    roi_names ... order of the rows (default: sorted Roi names)
+
+    The rows are normalized to sum 1, so that the product with a (pixels, t) block gives the
+    (weighted) mean trace of every Roi. Return the csr matrix and the list of Roi names.
+    """
+    from scipy import sparse
+    if roi_names is None:
+        roi_names = sorted(roi_dict)
+    n_pixels = int(np.prod(dims))
+    rows = []
+    for roi_name in roi_names:
+        mask = roi_dict[roi_name]
+        if sparse.issparse(mask):
+            row = sparse.csr_matrix(mask, dtype=np.float32).reshape((1, n_pixels))
+        else:
+            if isinstance(mask, tuple):
+                mask = np.ravel_multi_index(mask, dims)
+            mask = np.unique(np.asarray(mask, dtype=int).ravel())
+            row = sparse.csr_matrix((np.ones(mask.size, dtype=np.float32), mask, [0, mask.size]),
+                                    shape=(1, n_pixels))
+        rows.append(row)
+    weights = sparse.vstack(rows, format='csr')
+    weight_sums = np.asarray(weights.sum(axis=1), dtype=np.float32).ravel()
+    weight_sums[weight_sums == 0] = 1
+    weights = sparse.diags(1 / weight_sums).dot(weights).tocsr()
+    return weights.astype(np.float32), list(roi_names)
+
+
+def roiTracesBlock(weights, block, ignore_nan=True):
+    """
+    Return the Roi traces (Rois, t) of a (pixels, t) block for the rows of weights (see roiMatrix).
+
+    With ignore_nan, NaN pixels (e.g. background removed by segmentBackground) are left out and the
+    remaining weights of each Roi are renormalized per time point, as with np.nanmean.
+    """
+    block = np.asarray(block, dtype=np.float32)
+    nan_mask = np.isnan(block) if ignore_nan else None
+    if nan_mask is None or not nan_mask.any():
+        return weights.dot(block)
+    traces = weights.dot(np.where(nan_mask, 0, block))
+    valid_weights = weights.dot((~nan_mask).astype(np.float32))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        traces /= valid_weights
+    return traces
+
+
+def extractRoiTraces(mov, roi_matrix, block_frames=100, ignore_nan=True):
+    """
+    Extract the traces of all Rois from a movie with one sparse matrix product per block of frames.
+
+    Only the pixels covered by a Roi are read, as one (pixels, frames) block at a time.
+
+    mov ... movie (x, y, t), e.g. a numpy array or a lazy np.memmap (WidefieldDataUtils.memmapDCAM)
+    roi_matrix ... sparse (Rois, pixels) matrix from roiMatrix
+    block_frames ... number of frames read and processed at a time
+
+    Return a float32 array (Rois, t).
+    """
+    nt = mov.shape[2]
+    # only gather the pixels covered by any Roi
+    pixels = np.unique(roi_matrix.indices)
+    weights = roi_matrix[:, pixels]
+    xs, ys = np.unravel_index(pixels, mov.shape[:2])
+    traces = np.empty((roi_matrix.shape[0], nt), dtype=np.float32)
+    for start in range(0, nt, block_frames):
+        block = mov[xs, ys, start:start+block_frames]
+        traces[:, start:start+block.shape[1]] = roiTracesBlock(weights, block, ignore_nan)
+    return traces
+
+
+def extractRoiTracesRDD(rdd, roi_matrix, dims, ignore_nan=True, depth=2):
+    """
+    Extract the traces of all Rois from an RDD of (pixel, time series) records, e.g. from convert2RDD.
+
+    rdd keys are flat pixel indices or (x, y) tuples into the frame size dims.
+    Every partition multiplies its block of pixels with the matching columns of roi_matrix; the
+    partial sums are combined with a treeReduce of the given depth. Return a float32 array (Rois, t).
+    """
+    def partialSums(records):
+        stacked = stackRecords(records)
+        if stacked is None:
+            return []
+        keys, block = stacked
+        if isinstance(keys[0], tuple):
+            keys = np.ravel_multi_index(np.array(keys).T, dims)
+        weights = roi_matrix[:, np.asarray(keys)]
+        if not weights.nnz:
+            return []
+        block = block.astype(np.float32)
+        if ignore_nan:
+            nan_mask = np.isnan(block)
+            valid_weights = weights.dot((~nan_mask).astype(np.float32))
+            block[nan_mask] = 0
+        else:
+            valid_weights = np.asarray(weights.sum(axis=1)) * np.ones((1, block.shape[1]), np.float32)
+        return [(weights.dot(block), valid_weights)]
+
+    def addSums(a, b):
+        return (a[0] + b[0], a[1] + b[1])
+
+    sums, valid_weights = rdd.mapPartitions(partialSums).treeReduce(addSums, depth=depth)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / valid_weights).astype(np.float32)
+
+
+def trialStatsAdd(acc, trial):
+    """
+    Add one trial (e.g. movie (x, y, t)) to the running statistics acc of a trial type.
+
+    acc is a tuple (count, mean, m2) of float32 buffers, or None for no trials yet; m2 is the running
+    sum of squared deviations from the mean (Welford's update, which unlike plain sums of squares does
+    not lose precision in float32). The buffers of acc are updated in place and returned.
+    """
+    if acc is None:
+        return (1, np.array(trial, dtype=np.float32), np.zeros(np.shape(trial), dtype=np.float32))
+    count, mean, m2 = acc
+    count += 1
+    trial = np.asarray(trial, dtype=np.float32)
+    delta = trial - mean
+    mean += delta / count
+    delta *= trial - mean
+    m2 += delta
+    return (count, mean, m2)
+
+
+def trialStatsMerge(acc1, acc2):
+    """
+    Merge the running statistics of two sets of trials (see trialStatsAdd), reusing the buffers of acc1.
+    """
+    if acc1 is None:
+        return acc2
+    if acc2 is None:
+        return acc1
+    count1, mean1, m21 = acc1
+    count2, mean2, m22 = acc2
+    count = count1 + count2
+    delta = mean2 - mean1
+    mean1 += delta * (count2 / float(count))
+    delta *= delta
+    delta *= count1 * count2 / float(count)
+    m21 += m22
+    m21 += delta
+    return (count, mean1, m21)
+
+
+def trialStatsResult(acc, ddof=1):
+    """
+    Return a dict with 'count', 'mean', 'var' (with ddof degrees of freedom) and 'sem' from running
+    statistics (see trialStatsAdd). var and sem are NaN if there are not more than ddof trials.
+    """
+    count, mean, m2 = acc
+    if count > ddof:
+        var = m2 / np.float32(count - ddof)
+    else:
+        var = np.full(mean.shape, np.nan, dtype=np.float32)
+    return {'count': count, 'mean': mean, 'var': var, 'sem': np.sqrt(var / np.float32(count))}
+
+
+def trialAverage(trials, ddof=1):
+    """
+    Average trials by trial type in a single pass.
+
+    trials ... iterable of (trial_type, movie) tuples, e.g. a generator loading one trial at a time
+        from memmaps, so that only one trial and one accumulator per trial type are held in memory
+    Return a dict with trial types as keys and dicts as from trialStatsResult as values.
+    """
+    stats = dict()
+    for trial_type, trial in trials:
+        stats[trial_type] = trialStatsAdd(stats.get(trial_type), trial)
+    return dict((trial_type, trialStatsResult(acc, ddof)) for trial_type, acc in stats.items())
+
+
+def trialAverageRDD(rdd, ddof=1, method='aggregate', depth=2):
+    """
+    Average trials by trial type for an RDD of (trial_type, movie) records.
+
+    Every partition keeps one running (count, mean, m2) accumulator per trial type, so that only these
+    accumulators instead of the raw trials are combined:
+    method ... 'aggregate' (aggregateByKey, a shuffle of the accumulators) or 'tree' (treeAggregate of
+        dicts of accumulators to the driver without shuffle, best for few trial types)
+    Return a dict with trial types as keys and dicts as from trialStatsResult as values.
+    """
+    if method == 'aggregate':
+        stats = rdd.aggregateByKey(None, trialStatsAdd, trialStatsMerge).collectAsMap()
+    elif method == 'tree':
+        def addTrial(stats, record):
+            stats[record[0]] = trialStatsAdd(stats.get(record[0]), record[1])
+            return stats
+
+        def mergeStats(stats1, stats2):
+            for trial_type, acc in stats2.items():
+                stats1[trial_type] = trialStatsMerge(stats1.get(trial_type), acc)
+            return stats1
+        stats = rdd.treeAggregate({}, addTrial, mergeStats, depth=depth)
+    else:
+        raise ValueError('Unknown method %s' % method)
+    return dict((trial_type, trialStatsResult(acc, ddof)) for trial_type, acc in stats.items())
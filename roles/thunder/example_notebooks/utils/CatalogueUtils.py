@@ -0,0 +1,319 @@
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import h5py
+
+import CacheUtils
+import parseDCIMGheader
+
+import logging
+logger = logging.getLogger(__name__)
+
+# default location of the catalogue database
+CATALOGUE_FILE = os.path.join(CacheUtils.CACHE_DIR, 'catalogue.sqlite')
+
+
+def openCatalogue(db_file=None):
+    """
+    Open (and create if necessary) the catalogue database and return the sqlite3 connection.
+
+    The catalogue has one row per recording file with the source (absolute path or
+    swift://container/object), its kind, the version it was read at (mtime and size, or Swift ETag)
+    and the extracted metadata as JSON. Files that could not be read have NULL metadata and the
+    error message, so that they are only read again once they change.
+    """
+    if db_file is None:
+        db_file = CATALOGUE_FILE
+    db_dir = os.path.dirname(db_file)
+    if db_dir and not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE IF NOT EXISTS recordings '
+                 '(source TEXT PRIMARY KEY, kind TEXT, version TEXT, info TEXT, updated REAL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS recordings_kind ON recordings (kind)')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(recordings)')]
+    if 'error' not in columns:
+        # catalogues created before errors were recorded
+        conn.execute('ALTER TABLE recordings ADD COLUMN error TEXT')
+    return conn
+
+
+def recordingKind(name):
+    """
+    Guess the kind of a recording file from its name: 'dcimg' (camera data), 'h5' (HDF5 data),
+    'trials' (trial index mat-file, see importTrialIndices) or 'behaviour' (behaviour log).
+    Mat-files that turn out not to be HDF5-based are catalogued as 'mat' (see extractInfo).
+    """
+    name = name.lower()
+    if name.endswith('.dcimg'):
+        return 'dcimg'
+    if name.endswith('.h5'):
+        return 'h5'
+    if name.endswith('.mat'):
+        return 'trials'
+    if name.endswith('.txt') or name.endswith('.log'):
+        return 'behaviour'
+    return None
+
+
+def dcimgInfo(source):
+    """
+    Return the header fields of a DCIMG file (path or seekable file-like object), together with
+    sample_rate, start_time and dropped_frames derived from the frame timestamps in the footer.
+    """
+    try:
+        info = parseDCIMGheader.main(source, footer=True)
+    except ValueError:
+        # truncated file without footer
+        return parseDCIMGheader.main(source)
+    timestamps = info.pop('timestamps')
+    framestamps = info.pop('framestamps')
+    if len(timestamps):
+        info['start_time'] = float(timestamps[0])
+    if len(timestamps) > 1:
+        info['sample_rate'] = float(1 / np.median(np.diff(timestamps)))
+        info['dropped_frames'] = int(np.sum(np.diff(framestamps) - 1))
+    return info
+
+
+def h5Info(source):
+    """
+    Return shape, chunks, compression, dtype, number of trials and sample rate of a HDF5 data file
+    (path or file-like object) as used by NeuroH5Utils, or the layout of all its datasets otherwise.
+    """
+    with h5py.File(source, 'r') as f:
+        trials = list(f.keys())
+        if trials and isinstance(f[trials[0]], h5py.Group) and 'NeuralData' in f[trials[0]]:
+            # assume that dims and time vector do not change, take values from the first trial
+            ImageData = f[trials[0]]['NeuralData']['ImageData']
+            ImageDataTime = f[trials[0]]['NeuralData']['ImageDataTime']
+            info = datasetInfo(ImageData)
+            info['nTrials'] = len(trials)
+            if ImageDataTime.size > 1:
+                t = ImageDataTime[:2].ravel()
+                info['sampF'] = float(1 / (t[1] - t[0]))
+            return info
+        datasets = dict()
+
+        def addDataset(name, obj):
+            if isinstance(obj, h5py.Dataset):
+                datasets[name] = datasetInfo(obj)
+        f.visititems(addDataset)
+        return {'datasets': datasets}
+
+
+def datasetInfo(dset):
+    return {
+        'shape': dset.shape,
+        'chunks': dset.chunks,
+        'compression': dset.compression,
+        'dtype': dset.dtype.str,
+    }
+
+
+# signature of HDF5 files, at offset 0, 512, 1024, ... (512 in v7.3 mat-files)
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+def isHdf5(source):
+    """
+    Return True if source (path or seekable file-like object) has the HDF5 signature.
+    """
+    fid = source if hasattr(source, 'read') else open(source, 'rb')
+    try:
+        for offset in (0, 512, 1024, 2048):
+            fid.seek(offset)
+            if fid.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE:
+                return True
+        return False
+    finally:
+        if fid is source:
+            fid.seek(0)
+        else:
+            fid.close()
+
+
+def trialsInfo(source):
+    """
+    Return the trial type mapping of a trial index mat-file (see WidefieldDataUtils.importTrialIndices).
+    """
+    from WidefieldDataUtils import importTrialIndices
+    return {'trial_indices': importTrialIndices(source, use_cache=False)}
+
+
+def behaviourInfo(path):
+    """
+    Return the trial table of a behaviour log file (see BehaviourAnalysisUtils.parseBehaviourLog).
+    """
+    from BehaviourAnalysisUtils import parseBehaviourLog
+    return {'trial_list': parseBehaviourLog(path)}
+
+
+def toJson(obj):
+    """
+    Convert numpy types, tuples and datetimes in obj recursively to JSON-serializable types.
+    """
+    if isinstance(obj, dict):
+        return dict((str(k), toJson(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, np.ndarray)):
+        return [toJson(v) for v in obj]
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, bytes) and not isinstance(obj, str):
+        return obj.decode('utf-8', 'replace')
+    return obj
+
+
+def extractInfo(source, kind):
+    """
+    Extract the catalogue metadata of a local file or a seekable file-like object of the given kind.
+
+    Return (kind, metadata); mat-files of kind 'trials' that are not HDF5-based (e.g. v5 files written
+    by SwiftStorageUtils.saveAsMat) are returned as kind 'mat' without metadata.
+    """
+    if kind == 'dcimg':
+        return kind, dcimgInfo(source)
+    elif kind == 'h5':
+        return kind, h5Info(source)
+    elif kind == 'trials':
+        if not isHdf5(source):
+            return 'mat', {}
+        return kind, trialsInfo(source)
+    elif kind == 'behaviour':
+        if hasattr(source, 'read'):
+            # parseBehaviourLog needs a file name
+            temp_dir = tempfile.mkdtemp()
+            try:
+                path = os.path.join(temp_dir, 'behaviour.txt')
+                with open(path, 'wb') as fid:
+                    shutil.copyfileobj(source, fid)
+                return kind, behaviourInfo(path)
+            finally:
+                shutil.rmtree(temp_dir)
+        return kind, behaviourInfo(source)
+    raise ValueError('Unknown kind %s' % kind)
+
+
+def updateCatalogue(conn, candidates, open_source, n_threads=8):
+    """
+    Extract and store the metadata of all candidates (source, kind, version) whose version differs from
+    the catalogue. open_source(source) returns the path or file-like object to read. Return the number
+    of updated recordings.
+
+    Files that cannot be read are stored with their version and the error (see openCatalogue).
+    """
+    known = dict(conn.execute('SELECT source, version FROM recordings').fetchall())
+    stale = [c for c in candidates if c[1] is not None and known.get(c[0]) != c[2]]
+    if not stale:
+        return 0
+
+    def extract(candidate):
+        source, kind, version = candidate
+        try:
+            kind, info = extractInfo(open_source(source), kind)
+            return (source, kind, version, json.dumps(toJson(info)), time.time(), None)
+        except Exception as e:
+            logger.warning('Could not read %s: %s' % (source, e))
+            return (source, kind, version, None, time.time(), str(e))
+
+    pool = ThreadPool(max(1, min(n_threads, len(stale))))
+    try:
+        rows = pool.map(extract, stale)
+    finally:
+        pool.close()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO recordings (source, kind, version, info, updated, error) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+
+def refreshCatalogue(file_list, kind=None, db_file=None, n_threads=8):
+    """
+    Add the local files in file_list to the catalogue, or update them if they changed (by mtime and size).
+
+    kind ... kind of all files, or None to guess it from the file names (see recordingKind)
+    Return the number of updated recordings.
+    """
+    candidates = []
+    for filename in file_list:
+        path, mtime, size = CacheUtils.fileKey(filename)
+        candidates.append((path, kind or recordingKind(path), '%r:%d' % (mtime, size)))
+    conn = openCatalogue(db_file)
+    try:
+        return updateCatalogue(conn, candidates, lambda source: source, n_threads)
+    finally:
+        conn.close()
+
+
+def refreshCatalogueSwift(container, prefix, conn_opts, kind=None, db_file=None, n_threads=8):
+    """
+    Add the Swift objects starting with prefix to the catalogue, or update them if their ETag changed.
+
+    Only the required byte ranges of the objects are read (see SwiftStorageUtils.openObject).
+    kind ... kind of all objects, or None to guess it from the object names (see recordingKind)
+    Return the number of updated recordings.
+    """
+    from SwiftStorageUtils import iterItems, openObject
+    candidates = []
+    for item in iterItems(container, conn_opts, prefix):
+        source = 'swift://%s/%s' % (container, item['name'])
+        candidates.append((source, kind or recordingKind(item['name']), item['hash']))
+
+    def openSource(source):
+        return openObject(container, source[len('swift://%s/' % container):], conn_opts)
+
+    conn = openCatalogue(db_file)
+    try:
+        return updateCatalogue(conn, candidates, openSource, n_threads)
+    finally:
+        conn.close()
+
+
+def getRecording(source, db_file=None):
+    """
+    Return the catalogued metadata of source (absolute path or swift://container/object), or None
+    (also if the file could not be read).
+    """
+    if not source.startswith('swift://'):
+        source = os.path.abspath(source)
+    conn = openCatalogue(db_file)
+    try:
+        row = conn.execute('SELECT info FROM recordings WHERE source = ?', (source,)).fetchone()
+    finally:
+        conn.close()
+    return json.loads(row[0]) if row and row[0] is not None else None
+
+
+def listRecordings(kind=None, prefix=None, db_file=None):
+    """
+    Return a dict with sources as keys and the catalogued metadata as values (without the files that
+    could not be read).
+
+    kind ... only recordings of this kind
+    prefix ... only sources starting with prefix (e.g. a directory or swift://container/folder)
+    """
+    query = 'SELECT source, info FROM recordings WHERE info IS NOT NULL'
+    args = []
+    if kind is not None:
+        query += ' AND kind = ?'
+        args.append(kind)
+    if prefix is not None:
+        query += ' AND substr(source, 1, ?) = ?'
+        args.extend([len(prefix), prefix])
+    conn = openCatalogue(db_file)
+    try:
+        rows = conn.execute(query, args).fetchall()
+    finally:
+        conn.close()
+    return dict((source, json.loads(info)) for source, info in rows)
@@ -0,0 +1,220 @@
+import numpy as np
+
+from CalciumAnalysisUtils import stackRecords
+
+
+def normalizeTraces(traces, dtype=np.float32):
+    """
+    Z-score traces (pixels, t) along time and scale them by 1/sqrt(t).
+
+    The dot product of two normalized traces is their Pearson correlation, so that blocks of the
+    correlation matrix are plain matrix products. Constant traces and traces with NaNs are set to 0.
+    """
+    traces = np.array(traces, dtype=dtype, ndmin=2)
+    traces -= traces.mean(axis=-1, keepdims=True)
+    norm = np.sqrt(np.einsum('ij,ij->i', traces, traces))
+    valid = np.isfinite(norm) & (norm > 0)
+    traces /= np.where(valid, norm, 1)[:, np.newaxis]
+    traces[~valid] = 0
+    return traces
+
+
+def seedCorrelation(data, seed, block_rows=4096):
+    """
+    Correlate every pixel time series of data with seed.
+
+    data ... movie (x, y, t) or traces (pixels, t)
+    seed ... seed time series (t), e.g. a Roi trace from CalciumAnalysisUtils.extractRoiTraces
+    Return the correlation map with the shape of data without the time axis.
+    """
+    traces = data.reshape(-1, data.shape[-1])
+    seed = normalizeTraces(seed)[0]
+    corr = np.empty(traces.shape[0], dtype=np.float32)
+    for start in range(0, traces.shape[0], block_rows):
+        corr[start:start+block_rows] = normalizeTraces(traces[start:start+block_rows]).dot(seed)
+    return corr.reshape(data.shape[:-1])
+
+
+def correlationTiles(z, tile_size=4096):
+    """
+    Yield (start_i, start_j, tile) for the tiles z[i] z[j]^T of the correlation matrix of normalized
+    traces z (see normalizeTraces) on and above the diagonal (start_i <= start_j).
+    """
+    n = z.shape[0]
+    for start_i in range(0, n, tile_size):
+        for start_j in range(start_i, n, tile_size):
+            yield start_i, start_j, z[start_i:start_i+tile_size].dot(z[start_j:start_j+tile_size].T)
+
+
+def tileTopK(tile, k, diagonal=False):
+    """
+    Return the column indices and values of the k largest entries in every row of tile (sorted
+    descending). With diagonal, the tile is on the diagonal of the correlation matrix and the
+    self-correlations are left out.
+    """
+    if diagonal:
+        tile = tile.copy()
+        np.fill_diagonal(tile, -np.inf)
+    k = min(k, tile.shape[1])
+    rows = np.arange(tile.shape[0])[:, np.newaxis]
+    idx = np.argpartition(-tile, k - 1, axis=1)[:, :k]
+    values = tile[rows, idx]
+    order = np.argsort(-values, axis=1)
+    return idx[rows, order], values[rows, order]
+
+
+def mergeTopK(idx1, values1, idx2, values2, k):
+    """
+    Merge two (rows, k) sets of top-k candidates (see tileTopK) into the k largest per row.
+    """
+    idx = np.hstack((idx1, idx2))
+    values = np.hstack((values1, values2))
+    order = np.argsort(-values, axis=1, kind='mergesort')[:, :k]
+    rows = np.arange(values.shape[0])[:, np.newaxis]
+    return idx[rows, order], values[rows, order]
+
+
+def topKCorrelations(data, k=10, tile_size=4096):
+    """
+    Find the k pixels with the highest correlation for every pixel (without itself).
+
+    data ... movie (x, y, t) or traces (pixels, t)
+    The correlation matrix is computed tile by tile and never held in memory as a whole.
+    Return (indices, values), both (pixels, k) arrays; indices are flat pixel indices into data.
+    Rows have -1 / -inf entries if there are fewer than k other pixels.
+    """
+    z = normalizeTraces(data.reshape(-1, data.shape[-1]))
+    n = z.shape[0]
+    best_idx = np.full((n, k), -1, dtype=np.int64)
+    best_values = np.full((n, k), -np.inf, dtype=np.float32)
+    for start_i, start_j, tile in correlationTiles(z, tile_size):
+        rows_i = slice(start_i, start_i + tile.shape[0])
+        idx, values = tileTopK(tile, k, diagonal=start_i == start_j)
+        best_idx[rows_i], best_values[rows_i] = mergeTopK(best_idx[rows_i], best_values[rows_i],
+                                                          idx + start_j, values, k)
+        if start_i != start_j:
+            rows_j = slice(start_j, start_j + tile.shape[1])
+            idx, values = tileTopK(tile.T, k)
+            best_idx[rows_j], best_values[rows_j] = mergeTopK(best_idx[rows_j], best_values[rows_j],
+                                                              idx + start_i, values, k)
+    best_idx[~np.isfinite(best_values)] = -1
+    return best_idx, best_values
+
+
+def thresholdCorrelations(data, threshold=0.5, tile_size=4096):
+    """
+    Return all pixel pairs with a correlation of at least threshold as symmetric scipy.sparse csr
+    matrix (pixels, pixels) without the diagonal.
+
+    data ... movie (x, y, t) or traces (pixels, t)
+    """
+    from scipy import sparse
+    z = normalizeTraces(data.reshape(-1, data.shape[-1]))
+    n = z.shape[0]
+    rows, cols, values = [], [], []
+    for start_i, start_j, tile in correlationTiles(z, tile_size):
+        above = tile >= threshold
+        if start_i == start_j:
+            above = np.triu(above, 1)
+        i, j = np.nonzero(above)
+        rows.append(i + start_i)
+        cols.append(j + start_j)
+        values.append(tile[i, j])
+    rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+    upper = sparse.coo_matrix((values, (rows, cols)), shape=(n, n))
+    return (upper + upper.T).tocsr()
+
+
+def seedCorrelationRDD(rdd, seed):
+    """
+    Correlate every record of an RDD of (key, time series) records with seed (see seedCorrelation).
+
+    rdd ... e.g. from NeuroH5Utils.convert2RDD or convertDCAM2RDD(layout='series')
+    Return an RDD with (key, correlation) records and the partitioning of rdd.
+    """
+    seed = normalizeTraces(seed)[0]
+
+    def corrPartition(records):
+        stacked = stackRecords(records)
+        if stacked is None:
+            return []
+        keys, block = stacked
+        return list(zip(keys, normalizeTraces(block).dot(seed)))
+    return rdd.mapPartitions(corrPartition, preservesPartitioning=True)
+
+
+def normalizedBlocksRDD(rdd, block_size=4096):
+    """
+    Stack an RDD of (key, time series) records into normalized blocks (see normalizeTraces).
+
+    Return a cached RDD with ((partition, block), (keys, z)) records of at most block_size traces,
+    i.e. the row/column blocks of the tiled correlation matrix.
+    """
+    def stackPartition(part_ix, records):
+        records = list(records)
+        blocks = []
+        for counter, start in enumerate(range(0, len(records), block_size)):
+            keys, block = stackRecords(records[start:start+block_size])
+            blocks.append(((part_ix, counter), (keys, normalizeTraces(block))))
+        return blocks
+    return rdd.mapPartitionsWithIndex(stackPartition).cache()
+
+
+def tilePairsRDD(blocks):
+    """
+    Return an RDD with all pairs of blocks (see normalizedBlocksRDD) on and above the diagonal.
+    """
+    return blocks.cartesian(blocks).filter(lambda pair: pair[0][0] <= pair[1][0])
+
+
+def topKCorrelationsRDD(rdd, k=10, block_size=4096):
+    """
+    Find the k records with the highest correlation for every record of an RDD of (key, time series)
+    records (see topKCorrelations).
+
+    Every tile of the correlation matrix is one matrix product of two blocks on an executor, which
+    only emits the top-k candidates of its rows and columns; the candidates are merged by key.
+    Return an RDD with (key, (neighbour keys, correlations)) records, sorted by correlation.
+    """
+    def tileCandidates(pair):
+        (block_i, (keys_i, z_i)), (block_j, (keys_j, z_j)) = pair
+        tile = z_i.dot(z_j.T)
+        candidates = []
+        sides = [(keys_i, keys_j, tile)]
+        if block_i != block_j:
+            sides.append((keys_j, keys_i, tile.T))
+        for row_keys, col_keys, t in sides:
+            idx, values = tileTopK(t, k, diagonal=block_i == block_j)
+            for row, key in enumerate(row_keys):
+                valid = np.isfinite(values[row])
+                candidates.append((key, ([col_keys[c] for c in idx[row][valid]], values[row][valid])))
+        return candidates
+
+    def mergeCandidates(a, b):
+        keys = a[0] + b[0]
+        values = np.concatenate((a[1], b[1]))
+        order = np.argsort(-values, kind='mergesort')[:k]
+        return ([keys[c] for c in order], values[order])
+
+    blocks = normalizedBlocksRDD(rdd, block_size)
+    return tilePairsRDD(blocks).flatMap(tileCandidates).reduceByKey(mergeCandidates)
+
+
+def thresholdCorrelationsRDD(rdd, threshold=0.5, block_size=4096):
+    """
+    Find all pairs of records of an RDD of (key, time series) records with a correlation of at least
+    threshold (see thresholdCorrelations).
+
+    Return an RDD with one (key_i, key_j, correlation) record per pair (each pair only once).
+    """
+    def tilePairs(pair):
+        (block_i, (keys_i, z_i)), (block_j, (keys_j, z_j)) = pair
+        tile = z_i.dot(z_j.T)
+        above = tile >= threshold
+        if block_i == block_j:
+            above = np.triu(above, 1)
+        i, j = np.nonzero(above)
+        return [(keys_i[a], keys_j[b], tile[a, b]) for a, b in zip(i, j)]
+
+    blocks = normalizedBlocksRDD(rdd, block_size)
+    return tilePairsRDD(blocks).flatMap(tilePairs)
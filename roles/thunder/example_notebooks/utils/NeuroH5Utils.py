@@ -1,5 +1,9 @@
 import numpy as np
 import h5py
+import parseDCIMGheader
+
+import logging
+logger = logging.getLogger(__name__)
 
 def getFileInfo(h5file):
     f = h5py.File(h5file, 'r')
@@ -16,41 +20,215 @@ def getFileInfo(h5file):
 
 
 def readPixel_map(ix, h5file, dim=1, debug=False):
-    # open file for reading
-    f = h5py.File(h5file, 'r')
-    for counter, iTrial in enumerate(f.keys()):
-        ImageData = f[iTrial]['NeuralData']['ImageData']
-        if not counter:
-            if dim == 1:
-                result = ImageData[:][ix,:]
-            elif dim == 2:
-                result = ImageData[:][:,ix]
-        else:
-            if dim == 1:
-                result = np.append(result, ImageData[:][ix,:])
-            elif dim == 2:
-                result = np.append(result, ImageData[:][:, ix])
-    if dim == 2:
-        result = np.reshape(result, (np.size(result)/len(f), len(f)), order='F')
+    records, _ = readPixelBlock_map((ix, ix+1), h5file, dim)
+    result = records[0][1]
     if (debug == True) and dim == 1:
         import pylab as plt
         plt.plot(result); # for debugging in notebook
-    f.close()
     return (ix, result)
 
 
-def convert2RDD(sc, h5file, numPartitions=10, dim=1):
-    dsetSz, sampF, nTrials = getFileInfo(h5file)
-    # setup rdd frames
-    frames = sc.parallelize(range(0, dsetSz[dim-1]), numPartitions)
+def readPixelBlock_map(ix_range, h5file, dim=1):
+    """
+    Read a contiguous range of pixels (dim=1) or time points (dim=2) of all trials in h5file.
+
+    ix_range ... tuple (start, stop) of the indices to read
+    Return a list with one (ix, data) tuple per index (as readPixel_map) and the number of bytes read.
+
+    The file is opened once and one hyperslab per trial is read directly into a preallocated array.
+    """
+    start, stop = int(ix_range[0]), int(ix_range[1])
+    f = h5py.File(h5file, 'r')
+    dsets = [f[iTrial]['NeuralData']['ImageData'] for iTrial in f.keys()]
+    if dim == 1:
+        # concatenate the trials along the time axis
+        lengths = [dset.shape[1] for dset in dsets]
+        result = np.empty((stop-start, sum(lengths)), dtype=dsets[0].dtype)
+        offset = 0
+        for dset, length in zip(dsets, lengths):
+            dset.read_direct(result, np.s_[start:stop, :], np.s_[:, offset:offset+length])
+            offset += length
+        records = [(ix, result[ix-start]) for ix in range(start, stop)]
+    elif dim == 2:
+        # one column per trial
+        result = np.empty((dsets[0].shape[0], stop-start, len(dsets)), dtype=dsets[0].dtype)
+        for counter, dset in enumerate(dsets):
+            dset.read_direct(result, np.s_[:, start:stop], np.s_[:, :, counter])
+        records = [(ix, result[:, ix-start, :]) for ix in range(start, stop)]
+    f.close()
+    logger.info('Read %d bytes for indices %d-%d of %s' % (result.nbytes, start, stop, h5file))
+    return records, result.nbytes
+
+
+def getChunkInfo(h5file):
+    f = h5py.File(h5file, 'r')
+    # assume that the storage layout does not change, take values from the first trial
+    ImageData = f[f.keys()[0]]['NeuralData']['ImageData']
+    chunkInfo = {
+        'shape': ImageData.shape,
+        'chunks': ImageData.chunks,
+        'compression': ImageData.compression,
+        'itemsize': ImageData.dtype.itemsize,
+        'nTrials': len(f.keys()),
+    }
+    f.close()
+    return chunkInfo
+
+
+def chunkAlignedRanges(nItems, chunkLen, itemBytes, partitionBytes, numPartitions=None):
+    """
+    Split range(nItems) into contiguous (start, stop) ranges with boundaries on chunk boundaries.
+
+    chunkLen ... chunk size along the split axis
+    itemBytes ... bytes read per index (across all trials)
+    partitionBytes ... target number of bytes per range (ignored if numPartitions is given)
+    numPartitions ... number of ranges (approximately, as boundaries are rounded to whole chunks)
+    """
+    if numPartitions:
+        itemsPerRange = int(np.ceil(nItems / float(numPartitions)))
+    else:
+        itemsPerRange = max(1, partitionBytes // max(1, itemBytes))
+    # round to whole chunks, so that every chunk is read (and decompressed) by one partition only
+    itemsPerRange = int(np.ceil(itemsPerRange / float(chunkLen))) * chunkLen
+    return [(start, min(start + itemsPerRange, nItems)) for start in range(0, nItems, itemsPerRange)]
+
+
+def convert2RDD(sc, h5file, numPartitions=None, dim=1, bytes_read=None, partitionBytes=64*2**20):
+    from pyspark.rdd import Partitioner
+    chunkInfo = getChunkInfo(h5file)
+    dsetSz = chunkInfo['shape']
+    # setup rdd with one contiguous, chunk aligned range of pixels per partition
+    chunkLen = chunkInfo['chunks'][dim-1] if chunkInfo['chunks'] else 1
+    itemBytes = chunkInfo['itemsize'] * dsetSz[2-dim] * chunkInfo['nTrials']
+    ranges = chunkAlignedRanges(dsetSz[dim-1], chunkLen, itemBytes, partitionBytes, numPartitions)
+    logger.info('Reading %s (chunks %s, compression %s) in %d partitions' %
+                (h5file, chunkInfo['chunks'], chunkInfo['compression'], len(ranges)))
+
+    # bytes_read is an optional accumulator (sc.accumulator(0)) collecting the bytes read
+    def readBlock(ix_range):
+        records, nbytes = readPixelBlock_map(ix_range, h5file, dim)
+        if bytes_read is not None:
+            bytes_read.add(nbytes)
+        return records
+
     # read in the data from the HDF5 file into the rdd
     # note that this is lazily executed only once the data has to be accessed
-    rdd = frames.map(lambda x: readPixel_map(x, h5file, dim), preservesPartitioning=True)
-    # partition the rdd for faster lookup of elements
-    rdd = rdd.partitionBy(numPartitions).cache()
+    rdd = sc.parallelize(ranges, len(ranges)).flatMap(readBlock).cache()
+    # the records are already range partitioned, so register a matching partitioner
+    # (used e.g. by rdd.lookup) instead of shuffling the data with partitionBy
+    itemsPerRange = ranges[0][1] - ranges[0][0]
+    rdd.partitioner = Partitioner(len(ranges), lambda ix: ix // itemsPerRange)
     return rdd
 
 
+def readDCAMHeader(source, conn_opts=None):
+    """
+    Read and parse the header of a DCAM file, given as local path or as Swift object name.
+
+    conn_opts is a dict with connection settings for Swift (None for local/shared files).
+    """
+    if conn_opts is None:
+        return parseDCIMGheader.main(source)
+    from SwiftStorageUtils import readObjectRange
+    hdr_bytes = readObjectRange(conn_opts['swift_container'], source, 0, 232, conn_opts)
+    return parseDCIMGheader.parse_header_bytes(hdr_bytes)
+
+
+def readDCAMFrames_map(block, conn_opts=None):
+    """
+    Read the frames [start, stop) of a DCAM file and return them as 3D numpy array (x, y, t).
+
+    block ... tuple (source, hdr, block index, start, stop) as created by convertDCAM2RDD
+    conn_opts is a dict with connection settings for Swift (None for local/shared files).
+
+    Only the byte range holding the requested frames is read.
+    """
+    import WidefieldDataUtils as wf
+    source, hdr, _, start, stop = block
+    if conn_opts is None:
+        mov = wf.memmapDCAM(source, hdr)
+    else:
+        from SwiftStorageUtils import readObjectRange
+        bytes_per_img = wf.frameBytesDCAM(hdr)
+        buf = readObjectRange(conn_opts['swift_container'], source,
+                              hdr['data_offset'] + start*bytes_per_img, (stop-start)*bytes_per_img,
+                              conn_opts)
+        mov = wf.viewDCAM(buf, hdr, stop-start)
+        start, stop = 0, stop-start
+    return wf.readDCAMBlock(mov, frames=slice(start, stop))
+
+
+def readDCAMImages_map(block, conn_opts=None):
+    """
+    Read the frames [start, stop) of a DCAM file and return (key, frame) per frame.
+
+    block ... tuple (source, hdr, block index, start, stop) as created by convertDCAM2RDD
+    conn_opts is a dict with connection settings for Swift (None for local/shared files).
+    """
+    source, start = block[0], block[3]
+    mov = readDCAMFrames_map(block, conn_opts)
+    return [((source, start + i), mov[:, :, i]) for i in range(mov.shape[2])]
+
+
+def readDCAMRows_map(block):
+    """
+    Read the rows [start, stop) of all frames of a DCAM file and return (key, time series) per pixel.
+
+    block ... tuple (source, hdr, block index, start, stop) as created by convertDCAM2RDD
+    """
+    import WidefieldDataUtils as wf
+    source, hdr, _, start, stop = block
+    rows = wf.readDCAMBlock(wf.memmapDCAM(source, hdr), window=(slice(None), slice(start, stop)))
+    return [((source, ix, start + iy), rows[ix, iy, :])
+            for ix in range(rows.shape[0]) for iy in range(rows.shape[1])]
+
+
+def convertDCAM2RDD(sc, file_list, conn_opts=None, layout='blocks', block_bytes=64*2**20):
+    """
+    Load a list of DCAM files into an RDD, reading the data on the executors.
+
+    file_list ... list of local/shared file paths or of Swift object names
+    conn_opts ... dict with connection settings for Swift, if file_list holds Swift object names
+    layout ... layout of the records in the RDD:
+        'blocks': ((file, block index), frame block as (x, y, t) array)
+        'images': ((file, frame index), frame as 2D array)
+        'series': ((file, x, y), pixel time series); requires local/shared files
+    block_bytes ... approximate size of the data read by one partition
+
+    The file headers are read on the executors and only the block plan is built on the driver;
+    every partition then reads its own byte range of one file directly from disk or Swift. Choose block_bytes such that there are (many) more
+    blocks than executor cores, so that ingest throughput scales with the number of workers.
+    """
+    if layout not in ('blocks', 'images', 'series'):
+        raise ValueError('Unknown layout %s' % layout)
+    if layout == 'series' and conn_opts is not None:
+        raise ValueError('Layout series requires files that are readable by all executors')
+
+    # parse the headers on the executors (only the first bytes of every file are read)
+    headers = sc.parallelize(file_list, max(1, min(len(file_list), sc.defaultParallelism)))
+    headers = headers.map(lambda f: (f, readDCAMHeader(f, conn_opts))).collect()
+
+    # split every file into blocks of frames (or rows, for the series layout)
+    blocks = []
+    for source, hdr in headers:
+        if layout == 'series':
+            item_bytes = int(hdr['bytes_per_row']) * int(hdr['nframes'])
+            n_items = int(hdr['ysize'])
+        else:
+            item_bytes = int(hdr['bytes_per_img'])
+            n_items = int(hdr['nframes'])
+        items_per_block = max(1, block_bytes // max(1, item_bytes))
+        for block_ix, start in enumerate(range(0, n_items, items_per_block)):
+            blocks.append((source, hdr, block_ix, start, min(start + items_per_block, n_items)))
+
+    rdd = sc.parallelize(blocks, max(1, len(blocks)))
+    if layout == 'series':
+        return rdd.flatMap(readDCAMRows_map)
+    elif layout == 'images':
+        return rdd.flatMap(lambda b: readDCAMImages_map(b, conn_opts))
+    return rdd.map(lambda b: ((b[0], b[2]), readDCAMFrames_map(b, conn_opts)))
+
+
 def getReferenceImage(h5file, trial=0):
     f = h5py.File(h5file, 'r')
     refImage = f[f.keys()[trial]]['NeuralData']['ReferenceImage'][:]
@@ -60,12 +238,9 @@ def getReferenceImage(h5file, trial=0):
 
 def getStimData(h5file):
     f = h5py.File(h5file, 'r')
-    for counter, iTrial in enumerate(f.keys()):
-        stimData_trial = f[iTrial]['StimulusData']['StimulusData_001'][0]
-        if not counter:
-            stimNames = f[iTrial]['StimulusData']['StimNames_001'][:]
-            stimData = stimData_trial
-        else:
-            stimData = np.append(stimData, stimData_trial)
+    trials = list(f.keys())
+    stimNames = f[trials[0]]['StimulusData']['StimNames_001'][:]
+    # concatenate the stimulus data of all trials at once instead of growing the array per trial
+    stimData = np.concatenate([np.ravel(f[iTrial]['StimulusData']['StimulusData_001'][0]) for iTrial in trials])
     f.close()
     return stimData, stimNames
@@ -1,20 +1,262 @@
 import pickle
+import pickletools
 import os
+import shutil
+import struct
+import uuid
+import zlib
 
-def serialize(obj, file_name, path, obj_id):
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# arrays of at least this size are stored in side files instead of the pickle stream
+MIN_ARRAY_BYTES = 2**20
+
+
+def serialize(obj, file_name, path, obj_id, min_array_bytes=MIN_ARRAY_BYTES, compression=None, level=None):
     """
     Pickle a Python object
+
+    Large numpy arrays in obj (at least min_array_bytes) are not copied into the pickle, but written
+    out-of-band as .npy files to the directory <file>.pkl.arrays next to the pickle, so that deserialize
+    can memory-map them. The pickle (protocol 2, readable from Python 2) replaces a previous version
+    only once it has been written completely.
+
+    compression ... None (side files can be memory-mapped), 'zlib' or 'blosc' (requires the blosc
+                    package, otherwise zlib is used); compressed arrays are always loaded into memory
+    level ... compression level (zlib 1-9, default 1; blosc 0-9, default 5)
+    Return the path of the pickle file.
     """
     file_name = '%s_%s.pkl' % (file_name, obj_id)
     file_path = path + os.path.sep + file_name
-    with open(file_path, "wb") as pfile:
-        pickle.dump(obj, pfile, 2)
+    array_dir = file_path + '.arrays'
+    # the arrays of every version are written to their own subdirectory, so that the previous
+    # version of the pickle stays valid until it is replaced
+    version = uuid.uuid4().hex
+    if compression == 'blosc':
+        try:
+            import blosc
+        except ImportError:
+            logger.warning('blosc not available, using zlib instead')
+            compression = 'zlib'
+    temp_file = '%s.%s.tmp' % (file_path, version)
+    try:
+        with open(temp_file, "wb") as pfile:
+            pickler = ArrayPickler(pfile, array_dir, version, min_array_bytes, compression, level)
+            pickler.dump(obj)
+    except Exception:
+        os.remove(temp_file)
+        shutil.rmtree(os.path.join(array_dir, version), ignore_errors=True)
+        raise
+    # only the arrays of the replaced pickle are removed, concurrent writers keep their own
+    replaced = arrayNames(file_path) if os.path.isfile(file_path) else []
+    os.rename(temp_file, file_path)
+    for array_name in replaced:
+        if array_name.split('/')[0] == version:
+            continue
+        try:
+            os.remove(os.path.join(array_dir, array_name))
+        except OSError:
+            pass
+        if '/' in array_name:
+            try:
+                os.rmdir(os.path.join(array_dir, array_name.split('/')[0]))
+            except OSError:
+                # not empty yet or already removed
+                pass
+    return file_path
 
 
-def deserialize(file_path):
+def arrayNames(file_path):
+    """
+    Return the names of the side files referenced by the pickle file_path (see ArrayPickler), without
+    unpickling it.
+    """
+    names = []
+    # persistent ids are pickled as the tuple ('npy', array_name, compression), whose strings may
+    # be references to the memo
+    recent = []
+    memo = dict()
+    try:
+        with open(file_path, 'rb') as pfile:
+            for opcode, arg, _ in pickletools.genops(pfile):
+                if opcode.name in ('PUT', 'BINPUT', 'LONG_BINPUT', 'MEMOIZE'):
+                    memo[len(memo) if arg is None else arg] = recent[-1] if recent else None
+                    continue
+                if opcode.name in ('GET', 'BINGET', 'LONG_BINGET'):
+                    arg = memo.get(arg)
+                elif opcode.name == 'TUPLE3' and len(recent) == 3 and recent[0] == 'npy':
+                    name = recent[1]
+                    if isinstance(name, str) and not os.path.isabs(name) and '..' not in name:
+                        names.append(name)
+                recent = (recent + [arg])[-3:]
+    except Exception as e:
+        logger.warning('Could not read the side files of %s: %s' % (file_path, e))
+    return names
+
+
+def deserialize(file_path, mmap_mode=None):
     """
     Extracts a pickled Python object and returns it
+
+    mmap_mode ... None to read the out-of-band arrays (see serialize) into memory, or 'r' / 'c' to
+                  memory-map them (read-only / copy-on-write), so that only the accessed parts are read
+
+    The side files are found relative to file_path, so pickles on shared storage can be loaded by the
+    executors directly. Pickles without out-of-band arrays (e.g. written by older versions) load as before.
     """
     with open(file_path, "rb") as pfile:
-        obj = pickle.load(pfile)
+        obj = ArrayUnpickler(pfile, file_path + '.arrays', mmap_mode).load()
     return obj
+
+
+class ArrayPickler(pickle.Pickler):
+    """
+    Pickler that writes large numpy arrays to .npy side files and only pickles their file names.
+    """
+    def __init__(self, pfile, array_dir, version, min_array_bytes=MIN_ARRAY_BYTES, compression=None,
+                 level=None):
+        pickle.Pickler.__init__(self, pfile, 2)
+        self.array_dir = array_dir
+        self.version = version
+        self.min_array_bytes = min_array_bytes
+        self.compression = compression
+        self.level = level
+        # arrays written so far by id, so that shared references are written once
+        self.written = dict()
+
+    def persistent_id(self, obj):
+        # subclasses (e.g. masked arrays, matrices) are pickled as usual, to keep their attributes
+        if type(obj) not in (np.ndarray, np.memmap) or obj.dtype.hasobject or obj.nbytes < self.min_array_bytes:
+            return None
+        if id(obj) in self.written:
+            return self.written[id(obj)][1]
+        version_dir = os.path.join(self.array_dir, self.version)
+        if not os.path.isdir(version_dir):
+            os.makedirs(version_dir)
+        array_name = '%s/%d.npy' % (self.version, len(self.written))
+        with open(os.path.join(self.array_dir, array_name), 'wb') as fid:
+            if self.compression is None:
+                np.save(fid, np.asarray(obj))
+            else:
+                writer = CompressedWriter(fid, self.compression, self.level, obj.dtype.itemsize)
+                np.lib.format.write_array(writer, np.asarray(obj))
+                writer.close()
+        pid = ('npy', array_name, self.compression)
+        # keep obj alive, so that its id is not reused
+        self.written[id(obj)] = (obj, pid)
+        return pid
+
+
+class ArrayUnpickler(pickle.Unpickler):
+    """
+    Unpickler that loads the arrays written by ArrayPickler, optionally memory-mapped.
+    """
+    def __init__(self, pfile, array_dir, mmap_mode=None):
+        pickle.Unpickler.__init__(self, pfile)
+        self.array_dir = array_dir
+        self.mmap_mode = mmap_mode
+        # arrays loaded so far by name, so that shared references are loaded once
+        self.loaded = dict()
+
+    def persistent_load(self, pid):
+        kind, array_name, compression = pid
+        if kind != 'npy':
+            raise pickle.UnpicklingError('Unknown persistent id %r' % (pid,))
+        if array_name not in self.loaded:
+            array_file = os.path.join(self.array_dir, array_name)
+            if compression is None:
+                self.loaded[array_name] = np.load(array_file, mmap_mode=self.mmap_mode)
+            else:
+                with open(array_file, 'rb') as fid:
+                    self.loaded[array_name] = np.lib.format.read_array(CompressedReader(fid, compression))
+        return self.loaded[array_name]
+
+
+class CompressedWriter(object):
+    """
+    Write-only file object that compresses the data written to fid (zlib stream, or blosc frames with
+    a length prefix, as blosc is limited to 2 GB per call).
+    """
+    def __init__(self, fid, compression, level=None, typesize=1):
+        self.fid = fid
+        self.compression = compression
+        if compression == 'zlib':
+            self.compressor = zlib.compressobj(1 if level is None else level)
+        elif compression == 'blosc':
+            import blosc
+            self.blosc = blosc
+            self.level = 5 if level is None else level
+            self.typesize = typesize
+        else:
+            raise ValueError('Unknown compression %s' % compression)
+
+    def write(self, data):
+        if self.compression == 'zlib':
+            self.fid.write(self.compressor.compress(data))
+        else:
+            frame = self.blosc.compress(bytes(data), typesize=self.typesize, clevel=self.level,
+                                        shuffle=self.blosc.SHUFFLE, cname='lz4')
+            self.fid.write(struct.pack('<Q', len(frame)))
+            self.fid.write(frame)
+
+    def close(self):
+        if self.compression == 'zlib':
+            self.fid.write(self.compressor.flush())
+
+
+class CompressedReader(object):
+    """
+    Read-only file object that decompresses the data written by CompressedWriter.
+    """
+    def __init__(self, fid, compression, part_bytes=2**22):
+        self.fid = fid
+        self.compression = compression
+        self.part_bytes = part_bytes
+        if compression == 'zlib':
+            self.decompressor = zlib.decompressobj()
+            self.tail = b''
+        elif compression == 'blosc':
+            import blosc
+            self.blosc = blosc
+        else:
+            raise ValueError('Unknown compression %s' % compression)
+        # decompressed data not read yet starts at buffer[offset]
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def read(self, size):
+        while len(self.buffer) - self.offset < size:
+            part = self.nextPart()
+            if part is None:
+                break
+            if self.offset > len(self.buffer) // 2:
+                # drop the data already read, at most once per buffer length (amortized linear)
+                del self.buffer[:self.offset]
+                self.offset = 0
+            self.buffer.extend(part)
+        data = bytes(self.buffer[self.offset:self.offset+size])
+        self.offset += len(data)
+        return data
+
+    def nextPart(self):
+        # return the next decompressed part (possibly empty), or None at the end of the file
+        if self.compression == 'zlib':
+            if self.decompressor is None:
+                return None
+            if not self.tail:
+                self.tail = self.fid.read(2**20)
+                if not self.tail:
+                    part = self.decompressor.flush()
+                    self.decompressor = None
+                    return part
+            # decompress at most part_bytes at a time
+            part = self.decompressor.decompress(self.tail, self.part_bytes)
+            self.tail = self.decompressor.unconsumed_tail
+            return part
+        prefix = self.fid.read(8)
+        if len(prefix) < 8:
+            return None
+        return self.blosc.decompress(self.fid.read(struct.unpack('<Q', prefix)[0]))
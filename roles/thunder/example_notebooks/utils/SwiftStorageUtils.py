@@ -2,12 +2,20 @@ from __future__ import print_function
 
 import swiftclient
 from swiftclient.service import SwiftService, SwiftError, SwiftUploadObject
-from swiftclient.multithreading import OutputManager
 
+import atexit
+import io
+import json
 import os
+import time
+try:
+    from urllib import quote, unquote
+except ImportError:
+    from urllib.parse import quote, unquote
 import tempfile
 import shutil
 import h5py
+import numpy as np
 
 import logging
 logging.basicConfig(level=logging.ERROR)
@@ -15,37 +23,161 @@ logging.getLogger("requests").setLevel(logging.ERROR)
 logging.getLogger("swiftclient").setLevel(logging.ERROR)
 logger = logging.getLogger(__name__)
 
-def listItems(container, conn_opts):
+# long-lived SwiftService instances of this process (see getSwiftService)
+_swift_services = {}
+
+# location of the cached container listings (see listItemsCached)
+MANIFEST_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'helmchen-spark', 'swift_manifests')
+
+def getSwiftService(conn_opts, object_threads=10, segment_threads=10):
+    """
+    Return a long-lived SwiftService for conn_opts.
+
+    One service (with its connections and authentication) is kept per process and set of options,
+    so that repeated calls do not pay for authentication and connection setup again.
+    conn_opts is a dict with connection settings for Swift.
+    object_threads ... number of objects uploaded/downloaded concurrently
+    segment_threads ... number of segments of a large object uploaded concurrently
+    """
+    key = (tuple(sorted((k, str(v)) for k, v in conn_opts.items())), object_threads, segment_threads)
+    if key not in _swift_services:
+        options = dict(conn_opts, object_uu_threads=object_threads, object_dd_threads=object_threads,
+                       segment_threads=segment_threads)
+        swift = SwiftService(options=options)
+        swift.__enter__()
+        atexit.register(swift.__exit__, None, None, None)
+        _swift_services[key] = swift
+    return _swift_services[key]
+
+
+def listItems(container, conn_opts, prefix=None, delimiter=None, use_cache=False):
     """
     Test if specified container exists. Return container items as list.
 
     conn_opts is a dict with connection settings for Swift.
+    prefix ... only list objects whose names start with prefix (filtered by the server)
+    delimiter ... roll up names containing the delimiter after the prefix into pseudo-folders
+    use_cache ... return the object names from the local manifest cache (see listItemsCached)
     """
+    if use_cache:
+        return [item['name'] for item in listItemsCached(container, conn_opts, prefix or '')]
     container_is_empty = True
     item_list = []
-    with SwiftService(options=conn_opts) as swift:
-        try:
-            list_parts_gen = swift.list(container=container)
-            for page in list_parts_gen:
-                if page["success"]:
-                    container_is_empty = False
-                    for item in page["listing"]:
-                        i_name = item["name"]
-                        i_size = int(item["bytes"])
-                        item_list.append(i_name)
-                        # print("%s [size: %s bytes]" % (i_name, i_size))
-        except SwiftError as e:
-            print("Could not access container %s. Make sure it has been created." % container)
-    if container_is_empty:
+    try:
+        for item in iterItems(container, conn_opts, prefix, delimiter):
+            container_is_empty = False
+            # with a delimiter, pseudo-folders are listed as subdir
+            item_list.append(item.get('name', item.get('subdir')))
+    except SwiftError as e:
+        print("Could not access container %s. Make sure it has been created." % container)
+    if container_is_empty and not prefix:
         print("Container %s exists but appears to be empty" % container)
     return item_list
 
-def uploadItems(container, folder, source_dir, file_list, conn_opts):
+
+def iterItems(container, conn_opts, prefix=None, delimiter=None):
+    """
+    Generator over the objects in a container, streamed one listing page at a time.
+
+    conn_opts is a dict with connection settings for Swift.
+    prefix, delimiter ... server-side filtering (see listItems)
+
+    Yields the listing entries as dicts with 'name', 'bytes', 'hash' (ETag) and 'last_modified'
+    (or with 'subdir' for pseudo-folders if a delimiter is given).
+    """
+    swift = getSwiftService(conn_opts)
+    list_opts = {'prefix': prefix, 'delimiter': delimiter}
+    for page in swift.list(container=container, options=list_opts):
+        if not page["success"]:
+            raise SwiftError(page["error"], container=container, exc=page["error"])
+        for item in page["listing"]:
+            yield item
+
+
+def listItemsCached(container, conn_opts, prefix='', max_age=600, validate=True, cache_dir=MANIFEST_CACHE_DIR):
+    """
+    Return the listing entries of a container (see iterItems) from an on-disk manifest cache.
+
+    The manifest of a container and prefix is listed from Swift only if it is not cached yet, older
+    than max_age seconds (None to never expire) or, with validate, if the object count or the bytes
+    used of the container (one HEAD request) changed since it was listed. uploadItems and deleteItems
+    of this process invalidate the affected manifests; validate catches changes made elsewhere
+    (e.g. by executors or other hosts).
+    conn_opts is a dict with connection settings for Swift.
+    """
+    manifest_file = os.path.join(cache_dir, manifestFileName(container, prefix))
+    stats = containerStats(container, conn_opts) if validate else None
+    if os.path.isfile(manifest_file):
+        if max_age is None or time.time() - os.path.getmtime(manifest_file) < max_age:
+            with open(manifest_file) as fid:
+                manifest = json.load(fid)
+            if not validate or manifest.get('stats') == stats:
+                return manifest['listing']
+    listing = [dict((k, item[k]) for k in ('name', 'bytes', 'hash', 'last_modified'))
+               for item in iterItems(container, conn_opts, prefix or None)]
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file first, so that concurrent readers never see a partial manifest
+    temp_file = '%s.%d.tmp' % (manifest_file, os.getpid())
+    with open(temp_file, 'w') as fid:
+        json.dump({'container': container, 'prefix': prefix, 'stats': stats, 'listing': listing}, fid)
+    os.rename(temp_file, manifest_file)
+    return listing
+
+
+def manifestFileName(container, prefix):
+    # quote escapes '@', so the separator is unambiguous
+    return '%s@%s.json' % (quote(container, ''), quote(prefix, ''))
+
+
+def containerStats(container, conn_opts):
+    """
+    Return [object count, bytes used] of a container from a HEAD request.
+    """
+    swift = getSwiftService(conn_opts)
+    stat_res = swift.stat(container=container)
+    if not stat_res['success']:
+        raise SwiftError(stat_res['error'], container=container, exc=stat_res['error'])
+    headers = stat_res['headers']
+    return [int(headers.get('x-container-object-count', -1)),
+            int(headers.get('x-container-bytes-used', -1))]
+
+
+def invalidateManifests(container, object_names=None, cache_dir=MANIFEST_CACHE_DIR):
+    """
+    Delete the cached manifests of a container (see listItemsCached).
+
+    object_names ... only delete the manifests whose prefix matches one of these objects
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for manifest_file in os.listdir(cache_dir):
+        name, sep, prefix = manifest_file[:-len('.json')].partition('@')
+        if not sep or not manifest_file.endswith('.json') or unquote(name) != container:
+            continue
+        prefix = unquote(prefix)
+        if object_names is None or any(o.startswith(prefix) for o in object_names):
+            try:
+                os.remove(os.path.join(cache_dir, manifest_file))
+            except OSError:
+                pass
+
+
+def uploadItems(container, folder, source_dir, file_list, conn_opts, segment_size=256*2**20,
+                skip_identical=True, object_threads=10, segment_threads=10):
     """
     Upload files to a pseudofolder in Swift container.
 
     Need to specify both source_dir and full path for each file.
     conn_opts is a dict with connection settings for Swift.
+    segment_size ... files larger than this are uploaded as segmented large objects (SLO if the
+        cluster supports it, DLO otherwise); None to disable segmentation
+    skip_identical ... skip files whose content matches the ETag of the existing object
+    object_threads, segment_threads ... upload concurrency (see getSwiftService)
+
+    Return a dict with the lists of 'uploaded', 'skipped' and 'failed' files, the number of
+    'bytes' uploaded, the duration in 'seconds' and the throughput in 'MBps'. Calling uploadItems
+    again with the same files only sends the files that were not uploaded successfully.
     """
 
     # Create list of SwiftUploadObjects
@@ -54,35 +186,51 @@ def uploadItems(container, folder, source_dir, file_list, conn_opts):
                 o, object_name='%s/%s' % (folder, o.replace(source_dir, '', 1))
             ) for o in file_list
         ]
+    upload_opts = {
+        'segment_size': segment_size,
+        'use_slo': None,
+        'skip_identical': skip_identical,
+    }
+    result = {'uploaded': [], 'skipped': [], 'failed': [], 'bytes': 0}
+    t_start = time.time()
     # Upload files to storage
-    with SwiftService(options=conn_opts) as swift, OutputManager() as out_manager:
-        try:
-            for r in swift.upload(container, objs):
-                if r['success']:
-                    if 'object' in r:
-                        print('Finished upload of object %s to container %s' %
-                              (r['object'], container))
-                    elif 'for_object' in r:
-                        print(
-                            '%s segment %s' % (r['for_object'],
-                                               r['segment_index'])
-                            )
-                else:
-                    error = r['error']
-                    if r['action'] == "create_container":
-                        logger.warning(
-                            'Warning: failed to create container '
-                            "'%s'%s", container, error
-                        )
-                    elif r['action'] == "upload_object":
-                        logger.error(
-                            "Failed to upload object %s to container %s: %s" %
-                            (container, r['object'], error)
+    swift = getSwiftService(conn_opts, object_threads, segment_threads)
+    try:
+        for r in swift.upload(container, objs, options=upload_opts):
+            if r['success']:
+                if r.get('status') == 'skipped-identical':
+                    result['skipped'].append(r['path'])
+                elif 'object' in r and r['action'] == 'upload_object':
+                    result['uploaded'].append(r['path'])
+                    result['bytes'] += os.path.getsize(r['path'])
+                    print('Finished upload of object %s to container %s' %
+                          (r['object'], container))
+                elif 'for_object' in r:
+                    print(
+                        '%s segment %s' % (r['for_object'],
+                                           r['segment_index'])
                         )
-                    else:
-                        logger.error("%s" % error)
-        except SwiftError as e:
-            logger.error(e.value)
+            else:
+                error = r['error']
+                if r['action'] == "create_container":
+                    logger.warning(
+                        'Warning: failed to create container '
+                        "'%s'%s", container, error
+                    )
+                elif r['action'] == "upload_object":
+                    result['failed'].append(r['path'])
+                    logger.error(
+                        "Failed to upload object %s to container %s: %s" %
+                        (container, r['object'], error)
+                    )
+                else:
+                    logger.error("%s" % error)
+    except SwiftError as e:
+        logger.error(e.value)
+    invalidateManifests(container, [o.object_name for o in objs])
+    result['seconds'] = time.time() - t_start
+    result['MBps'] = result['bytes'] / 2.0**20 / max(result['seconds'], 1e-6)
+    return result
 
 
 def downloadItems(container, objects, conn_opts, down_opts):
@@ -94,49 +242,155 @@ def downloadItems(container, objects, conn_opts, down_opts):
     down_opts is a dict with download settings for Swift.
     """
     try:
-        with SwiftService(options=conn_opts) as swift:
-            for down_res in swift.download(container=container, objects=objects, options=down_opts):
-                if down_res['success']:
-                    print("'%s' downloaded to %s" % (down_res['object'], down_opts['out_directory']))
-                    status = 1
-                else:
-                    print("'%s' download failed" % down_res['object'])
-                    status = 0
+        swift = getSwiftService(conn_opts)
+        for down_res in swift.download(container=container, objects=objects, options=down_opts):
+            if down_res['success']:
+                print("'%s' downloaded to %s" % (down_res['object'], down_opts['out_directory']))
+                status = 1
+            else:
+                print("'%s' download failed" % down_res['object'])
+                status = 0
     except SwiftError as e:
         logger.error(e.value)
         status = 0
     return status
 
 
+def readObjectRange(container, object_name, start, length, conn_opts):
+    """
+    Read part of an object in a Swift container with an HTTP Range request and return the bytes.
+
+    start ... offset of the first byte to read
+    length ... number of bytes to read
+    conn_opts is a dict with connection settings for Swift.
+    """
+    range_header = {'Range': 'bytes=%d-%d' % (start, start + length - 1)}
+
+    def get_range(conn):
+        headers, body = conn.get_object(container, object_name, headers=range_header)
+        return body
+
+    swift = getSwiftService(conn_opts)
+    return swift.thread_manager.object_dd_pool.submit(get_range).result()
+
+
+class SwiftObjectReader(io.RawIOBase):
+    """
+    Seekable, read-only file-like object for an object in a Swift container.
+
+    Every read is served by an HTTP Range request for exactly the requested bytes, so only the
+    parts of the object that are actually read are transferred. Use openObject to get a buffered
+    (read-ahead) version. The ETag identifies the version of the object (see CacheUtils.valueKey).
+    conn_opts is a dict with connection settings for Swift.
+    """
+    def __init__(self, container, object_name, conn_opts):
+        super(SwiftObjectReader, self).__init__()
+        self.container = container
+        self.object_name = object_name
+        self.conn_opts = conn_opts
+        self.position = 0
+        swift = getSwiftService(conn_opts)
+        for stat_res in swift.stat(container=container, objects=[object_name]):
+            if not stat_res['success']:
+                raise IOError("Could not access object %s in container %s: %s" %
+                              (object_name, container, stat_res['error']))
+            self.size = int(stat_res['headers']['content-length'])
+            self.etag = stat_res['headers'].get('etag')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError('Invalid whence %s' % whence)
+        return self.position
+
+    def readinto(self, b):
+        length = min(len(b), self.size - self.position)
+        if length <= 0:
+            return 0
+        data = readObjectRange(self.container, self.object_name, self.position, length,
+                               self.conn_opts)
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def readall(self):
+        # fetch the rest of the object with a single Range request (RawIOBase.readall reads 8 KB chunks)
+        length = self.size - self.position
+        if length <= 0:
+            return b''
+        data = readObjectRange(self.container, self.object_name, self.position, length, self.conn_opts)
+        self.position += len(data)
+        return data
+
+
+def openObject(container, object_name, conn_opts, buffer_size=8*2**20):
+    """
+    Open an object in a Swift container as seekable binary file-like object, without downloading it.
+
+    Reads are buffered with read-ahead of buffer_size bytes; larger reads are fetched with a single
+    Range request. The returned object can be passed to h5py.File (h5py >= 2.9), importDCAM and
+    parseDCIMGheader.main instead of a path.
+    conn_opts is a dict with connection settings for Swift.
+    """
+    return io.BufferedReader(SwiftObjectReader(container, object_name, conn_opts), buffer_size)
+
+
 def deleteItems(container, objects, conn_opts, print_success=True):
     """
     Delete objects in container without confirmation.
 
     objects is a list of objects to be deleted.
     conn_opts is a dict with connection settings for Swift.
+
+    If the cluster supports bulk deletes, the objects are deleted in batches of up to
+    max_deletes_per_request (usually 10000) objects per request. Return the number of deleted objects.
     """
-    with SwiftService(options=conn_opts) as swift:
-        del_iter = swift.delete(container=container, objects=objects)
-        for del_res in del_iter:
-            c = del_res.get('container', '')
-            o = del_res.get('object', '')
-            a = del_res.get('attempts')
-            if del_res['success'] and not del_res['action'] == 'bulk_delete':
-                rd = del_res.get('response_dict')
-                if rd is not None:
-                    t = dict(rd.get('headers', {}))
-                    if t:
-                        if print_success:
-                            print(
-                                'Successfully deleted {0}/{1} in {2} attempts '
-                                '(transaction id: {3})'.format(c, o, a, t)
-                            )
-                    else:
-                        if print_success:
-                            print(
-                                'Successfully deleted {0}/{1} in {2} '
-                                'attempts'.format(c, o, a)
-                            )
+    swift = getSwiftService(conn_opts)
+    n_deleted = 0
+    del_iter = swift.delete(container=container, objects=objects)
+    for del_res in del_iter:
+        c = del_res.get('container', '')
+        o = del_res.get('object', '')
+        a = del_res.get('attempts')
+        if del_res['action'] == 'bulk_delete':
+            if del_res['success']:
+                n_deleted += len(del_res.get('objects', []))
+            else:
+                logger.error("Bulk delete in container %s failed: %s" % (c, del_res.get('error')))
+        elif del_res['success']:
+            if del_res['action'] == 'delete_object':
+                n_deleted += 1
+            rd = del_res.get('response_dict')
+            if rd is not None:
+                t = dict(rd.get('headers', {}))
+                if t:
+                    if print_success:
+                        print(
+                            'Successfully deleted {0}/{1} in {2} attempts '
+                            '(transaction id: {3})'.format(c, o, a, t)
+                        )
+                else:
+                    if print_success:
+                        print(
+                            'Successfully deleted {0}/{1} in {2} '
+                            'attempts'.format(c, o, a)
+                        )
+    invalidateManifests(container, objects)
+    return n_deleted
 
 
 def deleteExistingFolder(container, folder_name, conn_opts, confirm=True):
@@ -146,8 +400,7 @@ def deleteExistingFolder(container, folder_name, conn_opts, confirm=True):
     conn_opts is a dict with connection settings for Swift.
     confirm ... whether to ask for confirmation or not when deleting existing folders
     """
-    container_items = listItems(container, conn_opts)
-    objects_to_delete = [i for i in container_items if i.startswith(folder_name)]
+    objects_to_delete = listItems(container, conn_opts, prefix=folder_name)
     if objects_to_delete:
         if confirm:
             print('Matching objects:')
@@ -162,11 +415,140 @@ def deleteExistingFolder(container, folder_name, conn_opts, confirm=True):
         print('No matching objects.')
 
 
-def saveAsH5(A, file_name, dataset_name, swift_folder, conn_opts):
+def h5DatasetOptions(shape, dtype, chunks='auto', compression='gzip', level=None, shuffle=False,
+                     time_axis=-1, chunk_bytes=2**20):
+    """
+    Return the keyword arguments for h5py's create_dataset to store an array of given shape and dtype.
+
+    chunks ... 'auto' (chosen by h5py), 'frames' (chunks of whole frames, fast to append and to read
+               frame-wise), 'pixels' (chunks of whole pixel time series, fast to read pixel-wise as in
+               NeuroH5Utils.convert2RDD), a tuple with the chunk shape, or None (contiguous, uncompressed)
+    compression ... 'gzip', 'lzf', 'blosc' (requires hdf5plugin, otherwise lzf is used) or None
+    level ... compression level for gzip (0-9, default 4) or blosc (0-9, default 5)
+    shuffle ... apply the HDF5 shuffle filter before compression (blosc uses its own shuffle)
+    time_axis ... axis of the time points, default -1 for movies as (x, y, t)
+    chunk_bytes ... target size of a chunk for 'frames' and 'pixels'
+    """
+    shape = tuple(shape)
+    if not shape:
+        # scalar datasets cannot be chunked or compressed
+        return {}
+    itemsize = np.dtype(dtype).itemsize
+    time_axis = time_axis % len(shape)
+    opts = {}
+    if chunks == 'auto':
+        opts['chunks'] = True
+    elif chunks in ('frames', 'pixels') and len(shape) > 1:
+        nt = max(1, shape[time_axis])
+        space_axes = [ax for ax in range(len(shape)) if ax != time_axis]
+        frame_size = max(1, int(np.prod([shape[ax] for ax in space_axes])))
+        chunk = list(shape)
+        if chunks == 'frames':
+            chunk[time_axis] = int(min(nt, max(1, chunk_bytes // (frame_size * itemsize))))
+        else:
+            chunk[time_axis] = nt
+            # split the pixels into blocks of roughly equal side length
+            n_pixels = max(1, chunk_bytes // (nt * itemsize))
+            side = int(max(1, n_pixels ** (1.0 / len(space_axes))))
+            for ax in space_axes:
+                chunk[ax] = min(max(1, shape[ax]), side)
+        opts['chunks'] = tuple(max(1, c) for c in chunk)
+    elif chunks is None:
+        opts['chunks'] = None
+    else:
+        opts['chunks'] = True if chunks in ('frames', 'pixels') else tuple(chunks)
+    if opts['chunks'] is None:
+        return opts
+
+    if compression == 'blosc':
+        try:
+            import hdf5plugin
+            opts.update(hdf5plugin.Blosc(cname='lz4', clevel=5 if level is None else level,
+                                         shuffle=hdf5plugin.Blosc.SHUFFLE))
+            return opts
+        except ImportError:
+            logger.warning('hdf5plugin not available, using lzf instead of blosc')
+            compression = 'lzf'
+    if compression is not None:
+        opts['compression'] = compression
+        if compression == 'gzip' and level is not None:
+            opts['compression_opts'] = level
+    if shuffle:
+        opts['shuffle'] = True
+    return opts
+
+
+def createAppendableDataset(hf, dataset_name, block_shape, dtype, time_axis=-1, **h5opts):
+    """
+    Create an empty dataset in the open HDF5 file hf that can be extended along the time axis.
+
+    block_shape ... shape of the first block to be appended, used to choose the chunk shape
+    h5opts ... chunks, compression, level, shuffle as in h5DatasetOptions
+    """
+    block_shape = list(block_shape)
+    time_axis = time_axis % len(block_shape)
+    opts = h5DatasetOptions(block_shape, dtype, time_axis=time_axis, **h5opts)
+    if not opts.get('chunks'):
+        # resizable datasets have to be chunked
+        opts['chunks'] = True
+    maxshape = list(block_shape)
+    maxshape[time_axis] = None
+    shape = list(block_shape)
+    shape[time_axis] = 0
+    return hf.create_dataset(dataset_name, shape=tuple(shape), maxshape=tuple(maxshape), dtype=dtype, **opts)
+
+
+def appendFrames(dset, block, time_axis=-1):
+    """
+    Append block (e.g. frames as (x, y, t)) to the resizable dataset dset along the time axis.
+    """
+    time_axis = time_axis % dset.ndim
+    n_old = dset.shape[time_axis]
+    n_new = n_old + block.shape[time_axis]
+    dset.resize(n_new, axis=time_axis)
+    sel = [slice(None)] * dset.ndim
+    sel[time_axis] = slice(n_old, n_new)
+    dset[tuple(sel)] = block
+    return dset
+
+
+def writeH5(A, h5file, dataset_name, time_axis=-1, **h5opts):
+    """
+    Write A as dataset_name to the local HDF5 file h5file.
+
+    A is array-like (converted with np.asarray), or an iterator / generator of blocks (e.g. frames as
+    (x, y, t)), which are appended along the time axis one by one, so that the whole data never has
+    to be held in memory.
+    h5opts ... chunks, compression, level, shuffle as in h5DatasetOptions
+    """
+    with h5py.File(h5file, 'w') as hf:
+        if not isIterator(A):
+            A = np.asarray(A)
+            opts = h5DatasetOptions(A.shape, A.dtype, time_axis=time_axis, **h5opts)
+            hf.create_dataset(dataset_name, data=A, **opts)
+        else:
+            dset = None
+            for block in A:
+                block = np.asarray(block)
+                if dset is None:
+                    dset = createAppendableDataset(hf, dataset_name, block.shape, block.dtype,
+                                                   time_axis=time_axis, **h5opts)
+                appendFrames(dset, block, time_axis)
+
+
+def isIterator(A):
+    # lists, tuples and scalars are array-like, only iterators and generators are streams of blocks
+    return hasattr(A, '__next__') or hasattr(A, 'next')
+
+
+def saveAsH5(A, file_name, dataset_name, swift_folder, conn_opts, chunks='auto', compression='gzip',
+             level=None, shuffle=False, time_axis=-1):
     """
     Save numpy array A as dataset_name in HDF5 file temp_dir/file_name.h5 and upload to Swift folder
 
     conn_opts is a dict with connection settings for Swift.
+    A may also be an iterator / generator of blocks of frames, which are appended to the file one by one.
+    chunks, compression, level, shuffle, time_axis ... storage layout, see h5DatasetOptions
     """
     # create a temporary directory
     temp_dir = tempfile.mkdtemp()
@@ -176,14 +558,12 @@ def saveAsH5(A, file_name, dataset_name, swift_folder, conn_opts):
         temp_dir = temp_dir + os.path.sep
     
     if file_name.endswith('.h5'):
-        # h5file = '%s%s' % (temp_dir, file_name)
         h5file = os.path.join(temp_dir, file_name)
     else:
-        h5file = '%s%s.h5' % (temp_dir, file_name)
         h5file = os.path.join(temp_dir, file_name + '.h5')
     print('Saving file %s' % (h5file), end="")
-    with h5py.File(h5file, 'w') as hf:
-        hf.create_dataset(dataset_name, data=A, compression="gzip")
+    writeH5(A, h5file, dataset_name, time_axis=time_axis, chunks=chunks, compression=compression,
+            level=level, shuffle=shuffle)
     print(' - Done')
     # upload file to Swift container
     print('Uploading file %s' % (h5file))
@@ -194,33 +574,22 @@ def saveAsH5(A, file_name, dataset_name, swift_folder, conn_opts):
     shutil.rmtree(temp_dir)
     
     
-def saveAsMat(A, file_name, dataset_name, swift_folder, conn_opts, trial_list=None):
+def saveAsMat(A, file_name, dataset_name, swift_folder, conn_opts, trial_list=None, trial_names=None):
     """
     Save numpy array A as dataset_name in Matlab file temp_dir/file_name.mat and upload to Swift folder
 
     conn_opts is a dict with connection settings for Swift.
     
     Optionally, provide a trial_list, in which case the file name is derived from trial ID and stim type
+    (or the precomputed trial_names from trialFileNames, to save many trials)
     """
     from scipy.io import savemat
-    from SwiftStorageUtils import uploadItems
     
-    if trial_list is not None:
+    if trial_list is not None or trial_names is not None:
         # figure out trial ID and condition
-        trial_id = int(file_name[file_name.rfind('_')+1:])
-        trial_stim = [a for a in trial_list if a[0] == trial_id][0][3]
-        
-        # find trial number based on trials of this type
-        count_by_trial = 0
-        trial_stim = [a for a in trial_list if a[0] == trial_id][0][3]
-        for i_trial in trial_list:
-            if i_trial[3] == trial_stim:
-                count_by_trial += 1
-            if i_trial[0] == trial_id:
-                break
-
-        # this makes up the mat-file name
-        matfile_name = 'cond_%s_trial%1.0f.mat' % (trial_stim[trial_stim.rfind(' ')+2:], count_by_trial)
+        if trial_names is None:
+            trial_names = trialFileNames(trial_list)
+        matfile_name = trial_names[int(file_name[file_name.rfind('_')+1:])]
     else:
         matfile_name = file_name
     
@@ -243,3 +612,87 @@ def saveAsMat(A, file_name, dataset_name, swift_folder, conn_opts, trial_list=No
 
     # delete temp dir
     shutil.rmtree(temp_dir)
+
+
+def trialFileNames(trial_list):
+    """
+    Map the trial IDs in trial_list to mat-file names 'cond_<stim>_trial<n>.mat' in a single pass.
+
+    n counts the trials of the same stimulus up to and including the trial (see saveAsMat).
+    """
+    trial_names = dict()
+    count_by_stim = dict()
+    for i_trial in trial_list:
+        trial_id, trial_stim = i_trial[0], i_trial[3]
+        count_by_stim[trial_stim] = count_by_stim.get(trial_stim, 0) + 1
+        if trial_id not in trial_names:
+            trial_names[trial_id] = 'cond_%s_trial%1.0f.mat' % (trial_stim[trial_stim.rfind(' ')+2:],
+                                                               count_by_stim[trial_stim])
+    return trial_names
+
+
+def saveAsMatBatch(items, dataset_name, swift_folder, conn_opts, trial_list=None, trial_names=None,
+                   n_threads=4, archive=None):
+    """
+    Save many numpy arrays as Matlab files and upload them to Swift folder with a single uploadItems call.
+
+    items ... iterable of (file_name, A) tuples, consumed a few arrays at a time
+    trial_list, trial_names ... derive the file names from trial ID and stim type (see saveAsMat)
+    n_threads ... number of files written (and compressed) in parallel
+    archive ... None to upload the individual mat-files, or the name of a zip archive that bundles them
+
+    Return the result of uploadItems.
+    """
+    from scipy.io import savemat
+    from multiprocessing.pool import ThreadPool
+    import itertools
+    import zipfile
+
+    if trial_list is not None and trial_names is None:
+        trial_names = trialFileNames(trial_list)
+
+    temp_dir = tempfile.mkdtemp() + os.path.sep
+    pool = ThreadPool(n_threads)
+
+    def saveItem(item):
+        file_name, A = item
+        if trial_names is not None:
+            matfile_name = trial_names[int(file_name[file_name.rfind('_')+1:])]
+        else:
+            matfile_name = file_name
+        matfile = os.path.join(temp_dir, matfile_name)
+        savemat(matfile, {dataset_name: A}, do_compression=True)
+        return matfile
+
+    try:
+        items = iter(items)
+        matfiles = []
+        while True:
+            # only a few arrays are held in memory at a time
+            chunk = list(itertools.islice(items, 2 * n_threads))
+            if not chunk:
+                break
+            matfiles.extend(pool.map(saveItem, chunk))
+        print('Saved %d files' % len(matfiles))
+        if archive is not None:
+            archive_file = os.path.join(temp_dir, archive)
+            # the mat-files are already compressed
+            with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+                for matfile in matfiles:
+                    zf.write(matfile, os.path.basename(matfile))
+            matfiles = [archive_file]
+        return uploadItems(conn_opts['swift_container'], swift_folder, temp_dir, matfiles, conn_opts)
+    finally:
+        pool.close()
+        shutil.rmtree(temp_dir)
+
+
+def saveAsMatRDD(rdd, dataset_name, swift_folder, conn_opts, trial_list=None, n_threads=4):
+    """
+    Save the (file_name, A) records of an RDD as Matlab files with one saveAsMatBatch call per partition.
+
+    The trial names are computed once on the driver (see trialFileNames).
+    """
+    trial_names = trialFileNames(trial_list) if trial_list is not None else None
+    rdd.foreachPartition(lambda records: saveAsMatBatch(records, dataset_name, swift_folder, conn_opts,
+                                                        trial_names=trial_names, n_threads=n_threads))
@@ -4,11 +4,13 @@ import numpy as np
 from scipy.ndimage.filters import gaussian_filter
 import scipy.optimize as opt
 from scipy import stats
-from scipy.misc import imresize
+from scipy import sparse
 import h5py
 from matplotlib import pylab as plt
 import matplotlib.animation as animation
 from SwiftStorageUtils import uploadItems
+import parseDCIMGheader
+import CacheUtils
 import os
 import tempfile
 import shutil
@@ -18,23 +20,100 @@ def importDCAM(filename, dims, timepoints):
     """
     Import data from DCAM (binary) file and return as 3D numpy array (movie).
 
-    filename ... full path to the DCAM file
+    filename ... full path to the DCAM file, or a seekable binary file-like object
+        (e.g. SwiftStorageUtils.openObject)
     dims ... dimensions of output array (width, height)
     timepoints ... number of timepoints
     """
-    with open(filename, 'rb') as fid:
-        fid.seek(233)
-        A = np.fromfile(fid, dtype='>u2')
-#         A = np.fromfile(fid, dtype=np.uint16).byteswap()
-    # TODO: consider using np.memmap here
-    A = A[:dims[0]*dims[1]*timepoints]
-    assert(len(A)==(dims[0]*dims[1]*timepoints))
+    n_values = dims[0]*dims[1]*timepoints
+    if hasattr(filename, 'read'):
+        # read only the required bytes from the stream
+        filename.seek(233)
+        A = np.frombuffer(filename.read(2*n_values), dtype='>u2')
+        assert(len(A)==n_values)
+    else:
+        # map the file instead of reading it, so that only the requested frames are loaded
+        # and the movie is copied into memory exactly once
+        A = np.memmap(filename, dtype='>u2', mode='r', offset=233, shape=(n_values,))
     mov = np.fliplr(A.reshape([dims[0], dims[1], timepoints], order='F'))
+    mov = mov.astype(np.uint16)
     # hack to remove strange pixels with very high intensity
-    mov[np.where(mov > 60000)] = 0
+    mov[mov > 60000] = 0
     return mov
 
 
+def memmapDCAM(filename, hdr=None):
+    """
+    Memory-map a DCAM (binary) file and return the movie as a lazy 3D array (x, y, t).
+
+    filename ... full path to the DCAM file
+    hdr ... parsed file header (optional, see parseDCIMGheader.main)
+
+    The geometry (number of frames, image size, row and frame padding, bit depth and data offset)
+    is taken from the file header. The returned array has the same layout and orientation as the
+    movie returned by importDCAM, but nothing is read from disk until it is indexed: frames
+    (mov[:,:,i]), frame ranges (mov[:,:,i:j]) and pixel windows (mov[x0:x1,y0:y1,:]) are views
+    into the file. Use readDCAMBlock to copy a part of the movie into memory.
+    """
+    if hdr is None:
+        hdr = parseDCIMGheader.main(filename)
+    data_offset = int(hdr['data_offset'])
+    bytes_per_img = frameBytesDCAM(hdr)
+
+    # do not map beyond the end of the file (e.g. for incompletely written files)
+    nframes = int(hdr['nframes'])
+    nframes = min(nframes, (os.path.getsize(filename) - data_offset) // bytes_per_img)
+
+    raw = np.memmap(filename, dtype=np.uint8, mode='r', offset=data_offset,
+                    shape=(nframes * bytes_per_img,))
+    return viewDCAM(raw, hdr, nframes)
+
+
+def frameBytesDCAM(hdr):
+    """
+    Return the number of bytes per frame (including padding) of a DCAM file with header hdr.
+    """
+    return max(int(hdr['bytes_per_img']), int(hdr['ysize']) * int(hdr['bytes_per_row']))
+
+
+def viewDCAM(buf, hdr, nframes):
+    """
+    Return DCAM image data as 3D array view (x, y, t) without copying.
+
+    buf ... buffer (e.g. np.memmap or bytes) starting at the first byte of a frame
+    hdr ... parsed file header (see parseDCIMGheader.main)
+    nframes ... number of frames contained in buf
+    """
+    bytes_per_pixel = hdr['bitdepth'] // 8
+    mov = np.ndarray(shape=(int(hdr['xsize']), int(hdr['ysize']), nframes),
+                     dtype='<u%d' % bytes_per_pixel, buffer=buf,
+                     strides=(bytes_per_pixel, int(hdr['bytes_per_row']), frameBytesDCAM(hdr)))
+    # equivalent of np.fliplr in importDCAM, as a view
+    return mov[:, ::-1, :]
+
+
+def readDCAMBlock(mov, frames=None, window=None, max_intensity=60000):
+    """
+    Copy a block of a memory-mapped DCAM movie into memory and return it as 3D numpy array.
+
+    mov ... movie returned by memmapDCAM
+    frames ... slice or index array of the frames to read (default: all frames)
+    window ... tuple of slices (x, y) selecting a pixel window (default: full frame)
+    max_intensity ... pixels above this value are set to 0 (as in importDCAM), None to keep them
+
+    Only the bytes of the requested block are read from disk.
+    """
+    if frames is None:
+        frames = slice(None)
+    if window is None:
+        window = (slice(None), slice(None))
+    block = np.array(mov[window[0], window[1], frames], dtype=mov.dtype.newbyteorder('='))
+    if max_intensity is not None:
+        # hack to remove strange pixels with very high intensity
+        block[block > max_intensity] = 0
+    return block
+
+
 def Gaussian2D((x, y), amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
     """
     Return a 2D Gaussian
@@ -86,6 +165,97 @@ def estimateBackground(img, bg_sd_pixel):
     return offset_fit
 
 
+def gaussian2DJacobian(xy, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
+    """
+    Return the Jacobian of Gaussian2D with respect to its 7 parameters (one column per parameter).
+    """
+    x, y = xy
+    dx = x - float(xo)
+    dy = y - float(yo)
+    cos_t, sin_t, sin_2t, cos_2t = np.cos(theta), np.sin(theta), np.sin(2*theta), np.cos(2*theta)
+    a = cos_t**2/(2*sigma_x**2) + sin_t**2/(2*sigma_y**2)
+    b = -sin_2t/(4*sigma_x**2) + sin_2t/(4*sigma_y**2)
+    c = sin_t**2/(2*sigma_x**2) + cos_t**2/(2*sigma_y**2)
+    dx2, dxdy, dy2 = dx**2, dx*dy, dy**2
+    e = np.exp(-(a*dx2 + 2*b*dxdy + c*dy2))
+    ae = amplitude*e
+
+    def dQ(da, db, dc):
+        return da*dx2 + 2*db*dxdy + dc*dy2
+
+    jac = np.empty((e.size, 7))
+    jac[:, 0] = e.ravel()
+    jac[:, 1] = (ae*(2*a*dx + 2*b*dy)).ravel()
+    jac[:, 2] = (ae*(2*b*dx + 2*c*dy)).ravel()
+    jac[:, 3] = (-ae*dQ(-cos_t**2/sigma_x**3, sin_2t/(2*sigma_x**3), -sin_t**2/sigma_x**3)).ravel()
+    jac[:, 4] = (-ae*dQ(-sin_t**2/sigma_y**3, -sin_2t/(2*sigma_y**3), -cos_t**2/sigma_y**3)).ravel()
+    jac[:, 5] = (-ae*dQ(sin_2t/2*(1/sigma_y**2 - 1/sigma_x**2),
+                        cos_2t/2*(1/sigma_y**2 - 1/sigma_x**2),
+                        sin_2t/2*(1/sigma_x**2 - 1/sigma_y**2))).ravel()
+    jac[:, 6] = 1
+    return jac
+
+
+def estimateBackgroundStack(mov, bg_sd_pixel, downsample=4, method='fit', percentile=5,
+                            block_frames=100):
+    """
+    Background estimation for all frames of a raw widefield movie.
+
+    mov ... 3D numpy array (x, y, t), e.g. from memmapDCAM
+    bg_sd_pixel ... SD of gaussion filter in pixel (at the resolution of mov)
+    downsample ... factor by which frames are downsampled (block average) before smoothing and fitting
+    method ... 'fit' (2D Gaussian fit as in estimateBackground) or 'percentile' (closed form estimate)
+    percentile ... percentile of the smoothed frame used by the 'percentile' method
+        and as fallback when the fit does not converge
+    block_frames ... number of frames read from mov at a time
+
+    Return a 1D numpy array with the background estimate for every frame.
+
+    The frames are smoothed in one call and fitted on a shared coordinate grid with an analytic
+    Jacobian. Every fit starts from the result of the previous frame.
+    """
+    d = max(1, int(downsample))
+    nx, ny, nt = (mov.shape[0] // d) * d, (mov.shape[1] // d) * d, mov.shape[2]
+    # downsample in blocks of frames, so that mov (e.g. a memmap) is never copied as a whole
+    small = np.empty((nx // d, ny // d, nt), dtype=np.float32)
+    for start in range(0, nt, block_frames):
+        block = np.asarray(mov[:nx, :ny, start:start+block_frames], dtype=np.float32)
+        small[:, :, start:start+block_frames] = \
+            block.reshape(nx // d, d, ny // d, d, block.shape[2]).mean(axis=(1, 3))
+    smoothed = gaussian_filter(small, (bg_sd_pixel / float(d), bg_sd_pixel / float(d), 0))
+    offsets = np.percentile(smoothed.reshape(-1, smoothed.shape[2]), percentile, axis=0)
+    if method == 'percentile':
+        return offsets
+    elif method != 'fit':
+        raise ValueError('Unknown method %s' % method)
+
+    # coordinate grid shared by all fits (same orientation as in estimateBackground)
+    x = np.linspace(0, smoothed.shape[0]-1, smoothed.shape[0])
+    y = np.linspace(0, smoothed.shape[1]-1, smoothed.shape[1])
+    xy = np.array(np.meshgrid(x, y))
+
+    def gaussian(xy, *params):
+        return Gaussian2D(xy, *params)
+
+    def jacobian(xy, *params):
+        return gaussian2DJacobian(xy, *params)
+
+    popt = None
+    for iFrame in range(smoothed.shape[2]):
+        img_smoothed = smoothed[:, :, iFrame]
+        if popt is None:
+            # initial guesses as in estimateBackground
+            popt = (np.max(img_smoothed), img_smoothed.shape[0] / 2, img_smoothed.shape[1] / 2,
+                    img_smoothed.shape[0] / 10, img_smoothed.shape[1] / 10, 0, np.min(img_smoothed))
+        try:
+            popt, pcov = opt.curve_fit(gaussian, xy, img_smoothed.ravel(), p0=popt, jac=jacobian)
+            offsets[iFrame] = popt[6]
+        except RuntimeError:
+            # no convergence: keep the percentile estimate and restart from the initial guesses
+            popt = None
+    return offsets
+
+
 def segmentBackground(mov, cutoff=0.0001, plot=False):
     """
     Background segmentation for raw widefield data.
@@ -97,15 +267,39 @@ def segmentBackground(mov, cutoff=0.0001, plot=False):
     Determine black background pixel (outside brain), to be discarded during subsequent analysis.
     Return mov with backfround set to np.nan
     """
+    mask = segmentBackgroundMask(mov, cutoff, kde='exact', plot=plot)
+    mov[~mask,:] = np.nan
+
+    return mov
+
+
+def segmentBackgroundMask(mov, cutoff=0.0001, kde='binned', block_frames=100, return_index=False,
+                          plot=False):
+    """
+    Background segmentation for raw widefield data, returning the foreground pixels.
+
+    mov ... 3d numpy array, e.g. from memmapDCAM (not modified)
+    cutoff ... histogram threshold for separating background / foreground pixels
+    kde ... 'binned' (histogram based, fast) or 'exact' (scipy.stats.gaussian_kde on all pixels)
+    block_frames ... number of frames read from mov at a time
+    return_index ... return flat indices of the foreground pixels instead of a boolean mask
+    plot ... plot histogram (for debugging)
 
+    Return a boolean 2D mask that is True for foreground (brain) pixels, or their flat indices.
+    The average image is accumulated in blocks of frames, so that mov is never copied as a whole.
+    """
     # calculate average image (across frames)
-    avg_img = np.mean(mov, axis=2)
+    avg_img = averageImage(mov, block_frames)
 
     # kernel density estimate (KDE) of average image intensity values
-    kernel = stats.gaussian_kde(avg_img.ravel(), bw_method=None)
-
-    positions = np.linspace(0, np.max(avg_img), 500)
-    kde_positions = kernel(positions)
+    positions = np.linspace(0, np.nanmax(avg_img), 500)
+    if kde == 'exact':
+        kernel = stats.gaussian_kde(avg_img.ravel(), bw_method=None)
+        kde_positions = kernel(positions)
+    elif kde == 'binned':
+        kde_positions = binnedKDE(avg_img.ravel(), positions)
+    else:
+        raise ValueError('Unknown kde %s' % kde)
 
     if plot:
         plt.plot(positions, kde_positions)
@@ -113,36 +307,150 @@ def segmentBackground(mov, cutoff=0.0001, plot=False):
     # determine cut off for background
     bg_thresh = positions[np.where(kde_positions<cutoff)[0]][0]
 
-    avg_img_masked = avg_img.copy()
-    avg_img_masked[avg_img<bg_thresh] = np.nan
+    mask = avg_img >= bg_thresh
+    if return_index:
+        return np.flatnonzero(mask)
+    return mask
 
-    mov[np.isnan(avg_img_masked),:] = np.nan
 
-    return mov
+def averageImage(mov, block_frames=100):
+    """
+    Return the average image (across frames) of a movie, accumulated in blocks of frames.
+    """
+    avg_img = np.zeros(mov.shape[:2])
+    for start in range(0, mov.shape[2], block_frames):
+        avg_img += np.sum(mov[:, :, start:start+block_frames], axis=2, dtype=np.float64)
+    return avg_img / mov.shape[2]
 
 
-def resizeMovie(mov, resolution, interp='bilinear'):
+def binnedKDE(values, positions):
+    """
+    Gaussian kernel density estimate of values, evaluated at equally spaced positions.
+
+    Same bandwidth (Scott's rule) as scipy.stats.gaussian_kde, but the values are binned into a
+    histogram on the grid of positions, which is then convolved with the sampled kernel. The cost
+    is linear in the number of values.
+    """
+    values = values[np.isfinite(values)]
+    step = positions[1] - positions[0]
+    bandwidth = np.std(values, ddof=1) * values.size**(-1/5.)
+    # pad the grid by the kernel support, so that values outside the positions contribute as well
+    n_pad = int(np.ceil(4 * bandwidth / step))
+    edges = positions[0] + step * (np.arange(-n_pad, len(positions) + n_pad + 1) - 0.5)
+    hist = np.histogram(values, bins=edges)[0]
+    kernel_x = step * np.arange(-n_pad, n_pad + 1)
+    kernel = np.exp(-0.5 * (kernel_x / bandwidth)**2) / (np.sqrt(2 * np.pi) * bandwidth)
+    density = np.convolve(hist, kernel, mode='same') / values.size
+    return density[n_pad:n_pad + len(positions)]
+
+
+def resizeMovie(mov, resolution, interp='bilinear', dtype=np.float32, n_threads=1, block_frames=100):
     """
     Resize all frames in movie to new resolution.
+
+    mov ... 3D numpy array (x, y, t)
+    resolution ... output frame size (x, y)
+    interp ... interpolation ('nearest', 'bilinear', 'bicubic' or 'lanczos'), as in scipy.misc.imresize
+    dtype ... dtype of the output (e.g. np.float32 or np.uint16)
+    n_threads ... number of threads resizing blocks of frames in parallel
+    block_frames ... number of frames resized at a time
+
+    Frames are resized with separable interpolation weights that are computed once per movie.
     """
     if not resolution:
         return mov
     if (mov.shape[0] == resolution[0]) and (mov.shape[1] == resolution[1]):
         return mov
 
-    mov_resized = np.empty((resolution[0], resolution[1], mov.shape[2]))
-    for iFrame in range(mov.shape[2]):
-        mov_resized[:,:,iFrame] = imresize(mov[:,:,iFrame], resolution, interp=interp, mode='F')
+    # the weights only have a few non-zero entries per row
+    weights_x = sparse.csr_matrix(resizeWeights(mov.shape[0], resolution[0], interp))
+    weights_y = sparse.csr_matrix(resizeWeights(mov.shape[1], resolution[1], interp))
+    nx, ny = resolution
+    mov_resized = np.empty((nx, ny, mov.shape[2]), dtype=dtype)
+
+    def resizeBlock(start):
+        block = np.asarray(mov[:, :, start:start+block_frames], dtype=np.float32)
+        nt = block.shape[2]
+        # resize along x, then along y (with y as leading axis)
+        block = weights_x.dot(block.reshape(mov.shape[0], -1)).reshape(nx, mov.shape[1], nt)
+        block = block.transpose(1, 0, 2).reshape(mov.shape[1], -1)
+        block = weights_y.dot(block).reshape(ny, nx, nt).transpose(1, 0, 2)
+        if np.issubdtype(mov_resized.dtype, np.integer):
+            info = np.iinfo(mov_resized.dtype)
+            block = np.clip(np.round(block), info.min, info.max)
+        mov_resized[:, :, start:start+block_frames] = block
+
+    starts = range(0, mov.shape[2], block_frames)
+    if n_threads > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(n_threads)
+        pool.map(resizeBlock, starts)
+        pool.close()
+    else:
+        for start in starts:
+            resizeBlock(start)
     return mov_resized
 
 
-def importTrialIndices(filename):
+def resizeFrame(img, resolution, interp='bilinear', dtype=np.float32):
+    """
+    Resize a single 2D image (same interpolation as resizeMovie).
+    """
+    return resizeMovie(img[:, :, np.newaxis], resolution, interp, dtype)[:, :, 0]
+
+
+def resizeWeights(n_in, n_out, interp='bilinear'):
+    """
+    Return the (n_out, n_in) matrix of interpolation weights for resizing one image axis.
+
+    The weights follow PIL's resampling (as used by scipy.misc.imresize): pixel centers are aligned
+    and the filter is widened when downsampling, so that all input pixels contribute.
+    """
+    scale = n_in / float(n_out)
+    centers = (np.arange(n_out) + 0.5) * scale
+    if interp == 'nearest':
+        weights = np.zeros((n_out, n_in), dtype=np.float32)
+        weights[np.arange(n_out), np.minimum(centers.astype(int), n_in - 1)] = 1
+        return weights
+
+    filters = {
+        'bilinear': (1.0, lambda x: np.maximum(1 - np.abs(x), 0)),
+        'bicubic': (2.0, lambda x: np.where(np.abs(x) < 1,
+                                            (1.5*np.abs(x) - 2.5)*x**2 + 1,
+                                            np.where(np.abs(x) < 2,
+                                                     ((-0.5*np.abs(x) + 2.5)*np.abs(x) - 4)*np.abs(x) + 2,
+                                                     0))),
+        'lanczos': (3.0, lambda x: np.where(np.abs(x) < 3, np.sinc(x) * np.sinc(x / 3.0), 0)),
+    }
+    filters['cubic'] = filters['bicubic']
+    if interp not in filters:
+        raise ValueError('Unknown interpolation %s' % interp)
+    support, kernel = filters[interp]
+    filter_scale = max(scale, 1.0)
+    support = support * filter_scale
+
+    # evaluate the filter for all input pixels within the support of every output pixel
+    pixels = np.arange(n_in)[np.newaxis, :]
+    lower = np.maximum(np.floor(centers - support + 0.5), 0)[:, np.newaxis]
+    upper = np.minimum(np.floor(centers + support + 0.5), n_in)[:, np.newaxis]
+    weights = kernel((pixels + 0.5 - centers[:, np.newaxis]) / filter_scale)
+    weights[(pixels < lower) | (pixels >= upper)] = 0
+    weights /= weights.sum(axis=1)[:, np.newaxis]
+    return weights.astype(np.float32)
+
+
+def importTrialIndices(filename, use_cache=True):
     """
     Import trial indices from a mat-file.
 
     Assume newer (i.e. > v7.3) mat-file which is HDF5-based.
     Return a dictionary with trial types as keys and index arrays as values.
+
+    use_cache ... memoize the result on disk, keyed by the modification time of the file
     """
+    if use_cache:
+        return CacheUtils.cachedByMtime(lambda: importTrialIndices(filename, use_cache=False),
+                                        filename, key='importTrialIndices')
     trial_ind = dict()
     with h5py.File(filename, 'r') as f:
         trial_types = f.keys()
@@ -151,17 +459,52 @@ def importTrialIndices(filename):
     return trial_ind
 
 
+def trialTypeLookup(trial_indices):
+    """
+    Invert the index dictionary from importTrialIndices.
+
+    Return a dense array with the trial type of every trial number as entry (None for trial numbers
+    without type), for use with getTrialType.
+    """
+    n_trials = 0
+    for trial_type in trial_indices:
+        if trial_indices[trial_type].size:
+            n_trials = max(n_trials, int(trial_indices[trial_type].max()) + 1)
+    lookup = np.empty(n_trials, dtype=object)
+    # assign in reverse, so that the first matching type wins as in the linear search
+    for trial_type in reversed(list(trial_indices)):
+        ix = trial_indices[trial_type]
+        lookup[ix[ix >= 0]] = trial_type
+    return lookup
+
+
 def getTrialType(filename, trial_indices):
     """
     Get trial type from file name and index dictionary.
+
+    trial_indices ... index dictionary from importTrialIndices, or (faster for many files) the
+        inverted index from trialTypeLookup
     """
     trial_index = int(filename[filename.rfind('_')+1:])
+    if isinstance(trial_indices, np.ndarray):
+        if 0 <= trial_index < len(trial_indices):
+            return trial_indices[trial_index]
+        return None
     for trial_type in trial_indices:
         if np.any(trial_indices[trial_type]==trial_index):
             return trial_type
 
 
-def importMatlabRois(roi_file, roi_dict, roi_dims, output_dims):
+def getTrialTypes(file_list, trial_indices):
+    """
+    Get the trial types of all files in file_list (see getTrialType) with a single inverted index.
+    """
+    if not isinstance(trial_indices, np.ndarray):
+        trial_indices = trialTypeLookup(trial_indices)
+    return [getTrialType(filename, trial_indices) for filename in file_list]
+
+
+def importMatlabRois(roi_file, roi_dict, roi_dims, output_dims, mask_format='coords', use_cache=True):
     """
     Import Roi coordinates from Matlab file.
 
@@ -173,32 +516,233 @@ def importMatlabRois(roi_file, roi_dict, roi_dims, output_dims):
         roi_dict (dict): A dict with Roi names as keys.
         roi_dims (tuple): Dimensions of Rois encoded in mat-file (e.g. (256,256)).
         output_dims (tuple): Output dimensions for Roi coordinates (e.g. (512,512)).
+        mask_format (str): 'coords' (row and column indices as from np.where), 'flat' (flat indices
+            into output_dims) or 'sparse' (1 x pixels scipy.sparse row with the interpolated mask weights).
+        use_cache (bool): Memoize the masks on disk, keyed by the modification time of the file.
 
     Returns:
         roi_dict: A dict with Roi names as keys and coordinates as values.
     """
-    with h5py.File(roi_file, 'r') as f:
-        for roi_name in f.keys():
-            if roi_name in roi_dict:
-                roi_pixel = f[roi_name][:].astype(int)
-                roi_coords = np.unravel_index(roi_pixel, roi_dims)
-                # adjust for Matlab 1-based indexing
-                row_indices = roi_coords[0] - 1
-                col_indices = roi_coords[1] - 1
-                # fliplr on the Roi coordinates
-                col_indices = col_indices + 2 * (roi_dims[1]/2 - col_indices)
-                # create Roi mask and resize as appropriate
-                mask = np.zeros(roi_dims)
-                mask[row_indices.astype(int), col_indices.astype(int)] = 1
-                mask = imresize(mask, output_dims, interp='bilinear', mode='F')
-
-                roi_dict[roi_name] =  np.where(mask>0)
+    if use_cache:
+        key = ('importMatlabRois', sorted(roi_dict), tuple(roi_dims), tuple(output_dims), mask_format)
+        masks = CacheUtils.cachedByMtime(
+            lambda: roiMasks(roi_file, list(roi_dict), roi_dims, output_dims, mask_format), roi_file, key)
+    else:
+        masks = roiMasks(roi_file, list(roi_dict), roi_dims, output_dims, mask_format)
+    roi_dict.update(masks)
     return roi_dict
 
 
-def saveMovie(A, trial_type, movie_id, sample_rate, t_axis, file_params):
+def roiMasks(roi_file, roi_names, roi_dims, output_dims, mask_format='coords'):
+    """
+    Read the Rois roi_names from Matlab file and return a dict with the masks of the Rois found.
+
+    All masks are built and resized together as one (x, y, roi) stack. See importMatlabRois.
+    """
+    with h5py.File(roi_file, 'r') as f:
+        names = [roi_name for roi_name in f.keys() if roi_name in roi_names]
+        roi_pixels = [f[roi_name][:].astype(int).ravel() for roi_name in names]
+    if not names:
+        return {}
+    roi_ix = np.repeat(np.arange(len(names)), [pixels.size for pixels in roi_pixels])
+    roi_coords = np.unravel_index(np.concatenate(roi_pixels), roi_dims)
+    # adjust for Matlab 1-based indexing
+    row_indices = roi_coords[0] - 1
+    col_indices = roi_coords[1] - 1
+    # fliplr on the Roi coordinates
+    col_indices = col_indices + 2 * (roi_dims[1]//2 - col_indices)
+    # create Roi masks and resize as appropriate
+    masks = np.zeros((roi_dims[0], roi_dims[1], len(names)), dtype=np.float32)
+    masks[row_indices, col_indices, roi_ix] = 1
+    masks = resizeMovie(masks, output_dims, interp='bilinear')
+
+    result = dict()
+    if mask_format == 'sparse':
+        weights = sparse.csr_matrix(np.where(masks > 0, masks, 0).reshape(-1, len(names)).T)
+        for counter, roi_name in enumerate(names):
+            result[roi_name] = weights[counter]
+    elif mask_format == 'flat':
+        for counter, roi_name in enumerate(names):
+            result[roi_name] = np.flatnonzero(masks[:, :, counter] > 0)
+    else:
+        for counter, roi_name in enumerate(names):
+            result[roi_name] = np.where(masks[:, :, counter] > 0)
+    return result
+
+
+def saveMovie(A, trial_type, movie_id, sample_rate, t_axis, file_params, method='ffmpeg', **render_opts):
+    """
+    Render movie A (x, y, t) as mp4 file and upload it to the Swift folder animations.
 
+    method ... 'ffmpeg' (colormap lookup and raw frames piped to ffmpeg at constant memory, see
+        renderMovie; render_opts are passed on) or 'matplotlib' (one imshow artist per frame)
+    """
     mp4_filename = "%s_%s_movie.mp4" % (trial_type, movie_id)
+    temp_dir = tempfile.mkdtemp() + os.path.sep
+    mp4_filename = "%s%s" % (temp_dir, mp4_filename)
+    print("Saving movie", end="")
+    if method == 'ffmpeg':
+        vmin, vmax = renderMovie(A, mp4_filename, t_axis, **render_opts)
+    elif method == 'matplotlib':
+        vmin, vmax = renderMovieMatplotlib(A, mp4_filename, sample_rate, t_axis)
+    else:
+        raise ValueError('Unknown method %s' % method)
+    print(" - Done")
+
+    # Upload to Swift
+    print('Uploading file %s' % (mp4_filename))
+    uploadItems(file_params['swift_container'], 'animations', temp_dir, [mp4_filename], file_params)
+
+    # delete the temp directory
+    shutil.rmtree(temp_dir)
+
+    print("Color scale: %1.2f - %1.2f" % (vmin, vmax))
+
+    print("Done\n\n")
+
+
+def saveMovieRDD(rdd, movie_id, sample_rate, t_axis, file_params, **render_opts):
+    """
+    Render the movies of an RDD of (trial_type, movie) records on the executors and upload them to the
+    Swift folder animations, with one uploadItems call per partition (see saveMovie and renderMovie).
+    """
+    def renderPartition(records):
+        temp_dir = tempfile.mkdtemp() + os.path.sep
+        mp4_files = []
+        for trial_type, A in records:
+            mp4_filename = "%s%s_%s_movie.mp4" % (temp_dir, trial_type, movie_id)
+            renderMovie(A, mp4_filename, t_axis, **render_opts)
+            mp4_files.append(mp4_filename)
+        if mp4_files:
+            uploadItems(file_params['swift_container'], 'animations', temp_dir, mp4_files, file_params)
+        shutil.rmtree(temp_dir)
+        return [os.path.basename(f) for f in mp4_files]
+    return rdd.mapPartitions(renderPartition).collect()
+
+
+def renderMovie(A, mp4_filename, t_axis=None, vmin=None, vmax=None, cmap='jet', fps=15, scale=2,
+                colorbar=True, block_frames=100, bitrate='1800k', ffmpeg=None):
+    """
+    Render movie A (x, y, t) to mp4_filename by piping raw RGB frames to an ffmpeg subprocess.
+
+    The frames are mapped through a colormap lookup table in blocks of block_frames, so memory does not
+    grow with the number of frames. NaNs are shown in white.
+    t_axis ... time of every frame; the time is stamped into the top right corner ('%1.2fs')
+    vmin, vmax ... color scale (default: nanmin and nanmax of A)
+    scale ... integer upsampling factor of the frames
+    colorbar ... append a vertical color scale on the right
+    ffmpeg ... path of the ffmpeg binary (default: matplotlib's animation.ffmpeg_path)
+
+    Return the color scale (vmin, vmax).
+    """
+    import subprocess
+    if vmin is None:
+        vmin = np.nanmin(A)
+    if vmax is None:
+        vmax = np.nanmax(A)
+    if ffmpeg is None:
+        ffmpeg = plt.rcParams['animation.ffmpeg_path']
+    lut = colormapLUT(cmap)
+    n_colors = lut.shape[0] - 1
+    height, width = A.shape[0] * scale, A.shape[1] * scale
+    if colorbar:
+        bar_width = max(4, width // 20)
+        levels = np.linspace(n_colors - 1, 0, height).round().astype(int)
+        bar = np.full((height, 2 * bar_width, 3), 255, dtype=np.uint8)
+        bar[:, bar_width:] = lut[levels][:, np.newaxis, :]
+        width += 2 * bar_width
+
+    command = [ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % (width, height), '-r', str(fps),
+               '-i', '-', '-an', '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', '-b:v', str(bitrate),
+               # libx264 requires even frame sizes
+               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', mp4_filename]
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        for start in range(0, A.shape[2], block_frames):
+            block = framesToRGB(A[:, :, start:start+block_frames], vmin, vmax, lut)
+            if scale > 1:
+                block = block.repeat(scale, axis=1).repeat(scale, axis=2)
+            if t_axis is not None:
+                for counter in range(block.shape[0]):
+                    stampText(block[counter], '%1.2fs' % (t_axis[start + counter]), scale=scale)
+            if colorbar:
+                block = np.concatenate((block, np.broadcast_to(bar, (block.shape[0],) + bar.shape)), axis=2)
+            proc.stdin.write(np.ascontiguousarray(block).tobytes())
+    finally:
+        proc.stdin.close()
+        returncode = proc.wait()
+    if returncode:
+        raise RuntimeError('ffmpeg failed with exit code %d' % returncode)
+    return vmin, vmax
+
+
+def colormapLUT(cmap='jet', n_colors=256):
+    """
+    Return a uint8 (n_colors + 1, 3) RGB lookup table of a matplotlib colormap, with white as last
+    entry (used for NaNs).
+    """
+    from matplotlib import cm
+    lut = np.empty((n_colors + 1, 3), dtype=np.uint8)
+    lut[:-1] = (cm.get_cmap(cmap)(np.linspace(0, 1, n_colors))[:, :3] * 255).round()
+    lut[-1] = 255
+    return lut
+
+
+def framesToRGB(frames, vmin, vmax, lut):
+    """
+    Map frames (x, y, t) through the lookup table lut (see colormapLUT) to uint8 RGB images (t, x, y, 3).
+    """
+    n_colors = lut.shape[0] - 1
+    frames = np.asarray(frames, dtype=np.float32)
+    ix = (frames - vmin) * ((n_colors - 1) / float(max(vmax - vmin, np.finfo(np.float32).tiny)))
+    nans = np.isnan(ix)
+    ix[nans] = 0
+    np.clip(ix, 0, n_colors - 1, out=ix)
+    ix = ix.round().astype(np.intp)
+    ix[nans] = n_colors
+    return lut[ix.transpose(2, 0, 1)]
+
+
+# 3x5 pixel glyphs for stampText
+_GLYPHS = {
+    '0': ('111', '101', '101', '101', '111'),
+    '1': ('010', '110', '010', '010', '111'),
+    '2': ('111', '001', '111', '100', '111'),
+    '3': ('111', '001', '111', '001', '111'),
+    '4': ('101', '101', '111', '001', '001'),
+    '5': ('111', '100', '111', '001', '111'),
+    '6': ('111', '100', '111', '101', '111'),
+    '7': ('111', '001', '001', '001', '001'),
+    '8': ('111', '101', '111', '101', '111'),
+    '9': ('111', '101', '111', '001', '111'),
+    '.': ('000', '000', '000', '000', '010'),
+    '-': ('000', '000', '111', '000', '000'),
+    's': ('000', '011', '100', '001', '110'),
+    ' ': ('000', '000', '000', '000', '000'),
+}
+
+
+def stampText(img, text, scale=1, color=0, margin=2):
+    """
+    Burn text (digits, '.', '-', 's') right-aligned into the top right corner of the RGB image img.
+    """
+    glyph_scale = 2 * scale
+    mask = np.hstack([np.array([[c == '1' for c in row] + [False] for row in _GLYPHS.get(char, _GLYPHS[' '])])
+                      for char in text])
+    mask = mask.repeat(glyph_scale, axis=0).repeat(glyph_scale, axis=1)
+    top = margin * scale
+    left = img.shape[1] - mask.shape[1] - margin * scale
+    if left < 0 or top + mask.shape[0] > img.shape[0]:
+        return img
+    img[top:top+mask.shape[0], left:left+mask.shape[1]][mask] = color
+    return img
+
+
+def renderMovieMatplotlib(A, mp4_filename, sample_rate, t_axis):
+    """
+    Render movie A (x, y, t) to mp4_filename with one matplotlib artist per frame (see saveMovie).
+    """
     fig = plt.figure('Average movie')
     ax = fig.add_subplot(111)
 
@@ -207,7 +751,6 @@ def saveMovie(A, trial_type, movie_id, sample_rate, t_axis, file_params):
     # ims is a list of lists, each row is a list of artists to draw in the
     # current frame; here we are just animating one artist, the image, in
     # each frame
-    print("Building movie frames", end="")
     ims = []
     vmin = np.nanmin(A)
     vmax = np.nanmax(A)
@@ -223,24 +766,15 @@ def saveMovie(A, trial_type, movie_id, sample_rate, t_axis, file_params):
     # Set up formatting for the movie files
     Writer = animation.writers['ffmpeg']
     writer = Writer(fps=15, metadata=dict(artist='Me'), bitrate=1800)
-    print(" - Done")
-
-    # Save the movie file in a temporary directory
-    print("Saving movie", end="")
-    temp_dir = tempfile.mkdtemp() + os.path.sep
-    mp4_filename = "%s%s" % (temp_dir, mp4_filename)
     ani.save(mp4_filename, writer=writer)
-    print(" - Done")
-
-    # Upload to Swift
-    print('Uploading file %s' % (mp4_filename))
-    uploadItems(file_params['swift_container'], 'animations', temp_dir, [mp4_filename], file_params)
-
-    # delete the temp directory
-    shutil.rmtree(temp_dir)
-
-    print("Color scale: %1.2f - %1.2f" % (vmin, vmax))
-
     plt.close()
+    return vmin, vmax
 
-    print("Done\n\n")
+
+# memoized versions for parameter sweeps, which only recompute the stages whose inputs changed
+# (see CacheUtils.memoize; hit/miss counts in CacheUtils.DEFAULT_CACHE.stats)
+importDCAMCached = CacheUtils.memoize(importDCAM)
+estimateBackgroundCached = CacheUtils.memoize(estimateBackground, depends=(Gaussian2D,))
+segmentBackgroundCached = CacheUtils.memoize(segmentBackground, ignore=('plot',),
+                                             depends=(segmentBackgroundMask, averageImage, binnedKDE))
+resizeMovieCached = CacheUtils.memoize(resizeMovie, ignore=('n_threads', 'block_frames'), depends=(resizeWeights,))
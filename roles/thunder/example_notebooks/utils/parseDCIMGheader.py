@@ -1,10 +1,33 @@
+from __future__ import print_function
+
 import struct
 import os
 import sys
+import numpy as np
 
 # adapted from https://github.com/orlandi/hamamatsuOrcaTools/blob/master/DCIMG_opener.py
 
-def main(file_or_bytes):
+# file header and session header of the (old format) DCIMG files
+HEADER_BYTES = 232
+HEADER_DTYPE = np.dtype({
+    'names': ['format_version', 'header_size', 'filesize', 'byte_depth', 'xsize_req', 'bytes_per_row',
+              'ysize', 'bytes_per_img', 'offset_to_data', 'session_data_size'],
+    'formats': ['<u4', '<u8', '<u8', '<u4', '<u4', '<u4', '<u4', '<u4', '<u4', '<u8'],
+    'offsets': [8, 40, 48, 156, 164, 168, 172, 176, 188, 192],
+    'itemsize': HEADER_BYTES,
+})
+# offset of the framestamps within the session footer
+FOOTER_STAMPS_OFFSET = 272
+
+def main(file_or_bytes, footer=False):
+    # file_or_bytes is a path, a file-like object (e.g. SwiftStorageUtils.openObject) or bytes
+    # with footer, the per-frame framestamps and timestamps are added (see read_footer)
+    if hasattr(file_or_bytes, 'read'):
+        file_or_bytes.seek(0)
+        hdr = parse_header_bytes(file_or_bytes.read(HEADER_BYTES))
+        if footer:
+            hdr.update(read_footer(file_or_bytes, hdr))
+        return hdr
     is_byte_stream = False
     try:
         is_file = os.path.isfile(file_or_bytes)
@@ -12,12 +35,13 @@ def main(file_or_bytes):
         is_byte_stream = True
         is_file = False
     if is_file:
+        # read header and footer from the same open file
         with open(file_or_bytes, 'rb') as fid:
-            fid.seek(0)
-            hdr_bytes = fid.read(232)
-    else:
-        hdr_bytes = file_or_bytes[:232]
-    hdr = parse_header_bytes(hdr_bytes)
+            return main(fid, footer)
+    hdr = parse_header_bytes(file_or_bytes[:HEADER_BYTES])
+    if footer:
+        start, length = footer_range(hdr)
+        hdr.update(parse_footer_bytes(file_or_bytes[start:start+length], hdr['nframes']))
     return hdr
 
 
@@ -33,62 +57,51 @@ def main(file_or_bytes):
 
 
 def parse_header_bytes(hdr_bytes):
+    # all fixed fields are decoded with one record layout (see HEADER_DTYPE)
+    fields = np.frombuffer(hdr_bytes, dtype=HEADER_DTYPE, count=1)[0]
     header = {}
 
-    bytes_to_skip = 4*from_bytes(hdr_bytes[8:12],byteorder='little')
-
-    curr_index = 8 + bytes_to_skip
-
-    # nframes
-    nfrms = from_bytes(hdr_bytes[curr_index:curr_index+4],byteorder='little')
-    header['nframes'] = nfrms
+    # nframes (the format version 0x7 happens to be the number of words before it)
+    bytes_to_skip = 4*int(fields['format_version'])
+    header['nframes'] = struct.unpack_from('<I', hdr_bytes, 8 + bytes_to_skip)[0]
 
     # filesize
-    curr_index = 48
-    header['filesize'] = from_bytes(hdr_bytes[curr_index:curr_index+8],byteorder='little')
+    header['filesize'] = int(fields['filesize'])
 
     # bytes per pixel
-    curr_index = 156
-    header['bitdepth'] = 8*from_bytes(hdr_bytes[curr_index:curr_index+4],byteorder='little')
-
-    # footer location
-    curr_index = 120
-    header['footer_loc'] = from_bytes(hdr_bytes[curr_index:curr_index+4],byteorder='little')
+    header['bitdepth'] = 8*int(fields['byte_depth'])
 
     # number of columns (x-size)
-    curr_index = 164
-    header['xsize_req'] = from_bytes(hdr_bytes[curr_index:curr_index+4],byteorder='little')
+    header['xsize_req'] = int(fields['xsize_req'])
 
     # bytes per row
-    curr_index = 168
-    header['bytes_per_row'] = from_bytes(hdr_bytes[curr_index:curr_index+4],byteorder='little')
+    header['bytes_per_row'] = int(fields['bytes_per_row'])
     #if we requested an image of nx by ny pixels, then DCIMG files
     #for the ORCA flash 4.0 still save the full array in x.
-    header['xsize'] = header['bytes_per_row']/2
+    header['xsize'] = header['bytes_per_row']//2
 
     # binning
     # this only works because MOSCAM always reads out 2048 pixels per row
     # at least when connected via cameralink. This would fail on USB3 connection
     # and probably for other cameras.
     # TODO: find another way to work out binning
-    header['binning'] = int(4096/header['bytes_per_row'])
+    header['binning'] = int(4096//header['bytes_per_row'])
 
     # funny entry pair which references footer location
-    curr_index = 192
-    odd = from_bytes(hdr_bytes[curr_index:curr_index+8],byteorder='little')
-    curr_index = 40
-    offset = from_bytes(hdr_bytes[curr_index:curr_index+8],byteorder='little')
-    header['footer_loc'] = odd+offset
+    # (file header size + size of the session data)
+    offset = int(fields['header_size'])
+    header['footer_loc'] = int(fields['session_data_size']) + offset
+
+    # offset of the image data (file header size + offset of the data within the session)
+    header['data_offset'] = offset + int(fields['offset_to_data'])
 
     # number of rows
-    curr_index = 172
-    header['ysize'] = from_bytes(hdr_bytes[curr_index:curr_index+4],byteorder='little')
+    header['ysize'] = int(fields['ysize'])
 
     # TODO: what about ystart?
 
     # bytes per image
-    curr_index = 176
-    header['bytes_per_img'] = from_bytes(hdr_bytes[curr_index:curr_index+4],byteorder='little')
+    header['bytes_per_img'] = int(fields['bytes_per_img'])
 
     #if header['bytes_per_img'] != header['bytes_per_row']*header['ysize']:
     #    err_str = "bytes per img ({bytes_per_img}) /= nrows ({ysize}) * bytes_per_row
@@ -98,15 +111,79 @@ def parse_header_bytes(hdr_bytes):
     return header
 
 
+def footer_range(hdr):
+    # byte range (start, length) of the framestamps and timestamps in the session footer
+    # (only for the old DCIMG format, as read by WidefieldDataUtils.importDCAM)
+    return hdr['footer_loc'] + FOOTER_STAMPS_OFFSET, 12*hdr['nframes']
+
+
+def parse_footer_bytes(footer_bytes, nframes):
+    # nframes uint32 framestamps, followed by (seconds, microseconds) uint32 timestamp pairs
+    stamps = np.frombuffer(footer_bytes, dtype='<u4', count=3*nframes)
+    timestamps = stamps[nframes:].reshape(nframes, 2)
+    return {
+        'framestamps': stamps[:nframes].astype(np.int64),
+        'timestamps': timestamps[:, 0] + timestamps[:, 1]*1e-6,
+    }
+
+
+def read_footer(fid, hdr=None):
+    # read the framestamps and timestamps from an open (seekable) file
+    if hdr is None:
+        fid.seek(0)
+        hdr = parse_header_bytes(fid.read(HEADER_BYTES))
+    start, length = footer_range(hdr)
+    fid.seek(start)
+    return parse_footer_bytes(fid.read(length), hdr['nframes'])
+
+
+def parse_directory(directory, pattern='*.dcimg', footer=False, n_threads=8):
+    # parse the headers (and footers) of all matching files in directory in parallel
+    # return a dict with file paths as keys and headers as values
+    import glob
+    from multiprocessing.pool import ThreadPool
+    file_list = sorted(glob.glob(os.path.join(directory, pattern)))
+    pool = ThreadPool(max(1, min(n_threads, len(file_list))))
+    try:
+        headers = pool.map(lambda f: main(f, footer), file_list)
+    finally:
+        pool.close()
+    return dict(zip(file_list, headers))
+
+
+def parse_swift_prefix(container, prefix, conn_opts, suffix='.dcimg', footer=False, n_threads=8):
+    # parse the headers (and footers) of all objects in a Swift container whose names start with
+    # prefix and end with suffix, reading only the required byte ranges of every object in parallel
+    # return a dict with object names as keys and headers as values
+    from multiprocessing.pool import ThreadPool
+    from SwiftStorageUtils import iterItems, readObjectRange
+
+    def parse_object(object_name):
+        hdr = parse_header_bytes(readObjectRange(container, object_name, 0, HEADER_BYTES, conn_opts))
+        if footer:
+            start, length = footer_range(hdr)
+            hdr.update(parse_footer_bytes(readObjectRange(container, object_name, start, length, conn_opts),
+                                          hdr['nframes']))
+        return hdr
+
+    object_list = [item['name'] for item in iterItems(container, conn_opts, prefix)
+                   if item.get('name', '').endswith(suffix)]
+    pool = ThreadPool(max(1, min(n_threads, len(object_list))))
+    try:
+        headers = pool.map(parse_object, object_list)
+    finally:
+        pool.close()
+    return dict(zip(object_list, headers))
+
+
 # There is probably an easier way to do that
 def from_bytes (data, byteorder = 'little'):
+    # bytearray yields integers for both Python 2 str and Python 3 bytes
+    data = bytearray(data)
     if byteorder!='little':
         data = reversed(data)
     num = 0
-    for offset, byte in enumerate(data):
-        #nb = toBytes(byte)
-        nb = struct.unpack('B', byte[0])[0]
-        #num += nb[0] << (offset * 8)
+    for offset, nb in enumerate(data):
         num += nb << (offset * 8)
     return num
 
@@ -114,4 +191,4 @@ def from_bytes (data, byteorder = 'little'):
 if __name__ == '__main__':
     file_or_bytes = sys.argv[1]
     hdr = main(file_or_bytes)
-    print hdr
+    print(hdr)
@@ -0,0 +1,97 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import CacheUtils
+
+
+class FakeSwift(object):
+    """
+    In-memory stand-in for the SwiftStorageUtils functions used by ContentCache.
+    """
+    def __init__(self):
+        self.objects = dict()
+
+    def uploadItems(self, container, folder, source_dir, file_list, conn_opts):
+        for f in file_list:
+            with open(f, 'rb') as fid:
+                self.objects['%s/%s' % (folder, f.replace(source_dir, '', 1))] = fid.read()
+        return len(file_list)
+
+    def iterItems(self, container, conn_opts, prefix=None, delimiter=None):
+        for name in sorted(self.objects):
+            if name.startswith(prefix or ''):
+                yield {'name': name, 'bytes': len(self.objects[name]), 'hash': 'etag', 'last_modified': ''}
+
+    def downloadItems(self, container, objects, conn_opts, down_opts):
+        for name in objects:
+            path = os.path.join(down_opts['out_directory'], name[len(down_opts['prefix']):])
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as fid:
+                fid.write(self.objects[name])
+        return 1
+
+
+def scale(a, k, n_threads=1):
+    return a * k
+
+
+def test_swift_shared_hit(tmpdir, monkeypatch):
+    swift_utils = pytest.importorskip('SwiftStorageUtils')
+    fake = FakeSwift()
+    for name in ('uploadItems', 'iterItems', 'downloadItems'):
+        monkeypatch.setattr(swift_utils, name, getattr(fake, name))
+    swift = ('container', 'cache', {})
+    a = np.random.rand(600, 500)
+
+    cache1 = CacheUtils.ContentCache(str(tmpdir.join('1')), swift=swift)
+    r1 = CacheUtils.memoize(scale, cache=cache1, ignore=('n_threads',))(a, 2)
+    assert cache1.stats['scale'] == {'hits': 0, 'shared_hits': 0, 'misses': 1}
+    assert fake.objects
+
+    # another executor with an empty local cache
+    cache2 = CacheUtils.ContentCache(str(tmpdir.join('2')), swift=swift)
+    r2 = CacheUtils.memoize(scale, cache=cache2, ignore=('n_threads',))(a, k=2, n_threads=4)
+    assert cache2.stats['scale'] == {'hits': 0, 'shared_hits': 1, 'misses': 0}
+    assert np.array_equal(r1, r2)
+
+
+def test_function_key_changes_with_constants():
+    ns1, ns2 = dict(), dict()
+    exec('def f(a):\n    a[a > 60000] = 0\n    return a', ns1)
+    exec('def f(a):\n    a[a > 50000] = 0\n    return a', ns2)
+    assert CacheUtils.functionKey(ns1['f']) != CacheUtils.functionKey(ns2['f'])
+
+
+def test_depends_and_version_invalidate(tmpdir):
+    cache = CacheUtils.ContentCache(str(tmpdir))
+    ns1, ns2 = dict(), dict()
+    exec('def helper(x):\n    return x + 1', ns1)
+    exec('def helper(x):\n    return x + 2', ns2)
+    CacheUtils.memoize(scale, cache=cache, depends=(ns1['helper'],))(np.ones(3), 2)
+    CacheUtils.memoize(scale, cache=cache, depends=(ns1['helper'],))(np.ones(3), 2)
+    CacheUtils.memoize(scale, cache=cache, depends=(ns2['helper'],))(np.ones(3), 2)
+    CacheUtils.memoize(scale, cache=cache, version=2)(np.ones(3), 2)
+    assert cache.stats['scale'] == {'hits': 1, 'shared_hits': 0, 'misses': 3}
+
+
+def readHeader(filename):
+    with open(str(filename), 'rb') as fid:
+        return fid.read()
+
+
+@pytest.mark.parametrize('to_path', [str, lambda p: u'%s' % p, lambda p: __import__('pathlib').Path(str(p))])
+def test_rewritten_file_is_a_miss(tmpdir, to_path):
+    cache = CacheUtils.ContentCache(str(tmpdir.join('cache')))
+    cached = CacheUtils.memoize(readHeader, cache=cache)
+    data_file = tmpdir.join('x.dcimg')
+    data_file.write_binary(b'old')
+    assert cached(to_path(data_file)) == b'old'
+    assert cached(to_path(data_file)) == b'old'
+    data_file.write_binary(b'newer')
+    assert cached(to_path(data_file)) == b'newer'
+    assert cache.stats['readHeader'] == {'hits': 1, 'shared_hits': 0, 'misses': 2}